@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+#
+# Processing benchmarks that run without a sound card or display
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import struct
+import wave
+import numpy
+
+import dsp
+from dsp import rangeProfile, rangeDoppler, filterBank, pulseHistory, ringBuffer, relative_db, get_plan
+from engine import bufferPool, deinterleave
+from render import levelMap, levelImage
+from wavio import load_reference, read_wav
+
+# Best wall-clock time of several runs of a function, in seconds
+def best_time(func,repeats=5):
+    best=None
+    for i in range(0,repeats):
+        start=time.perf_counter()
+        func()
+        elapsed=time.perf_counter()-start
+        if best is None or elapsed < best:
+            best=elapsed
+    return best
+
+# The per-sample loader the tools used before wavio
+def legacy_unpack(str,bytesPerSample=2):
+    result=list()
+    for i in range(0,len(str)-1,bytesPerSample):
+        result.append(struct.unpack('h',str[i:i+bytesPerSample])[0])
+    return result
+
+def legacy_load(filename):
+    f=wave.open(filename,'r')
+    return numpy.array(legacy_unpack(f.readframes(f.getnframes()),f.getsampwidth()),dtype=numpy.float64)
+
+# Compare WAV reference loading on the bundled recordings
+def bench_wav_load():
+    for filename in ['squeak.wav','squeaks.wav']:
+        if not numpy.array_equal(legacy_load(filename),load_reference(filename)):
+            print(filename + ': loaders disagree!')
+        legacy=best_time(lambda: legacy_load(filename),repeats=1)
+        vectorized=best_time(lambda: load_reference(filename))
+        print('%-12s legacy %8.2f ms  wavio %8.3f ms  speedup %6.0fx' %
+              (filename,legacy*1000,vectorized*1000,legacy/vectorized))
+
+# Compare real and complex transforms in the sounder and matfilter chains
+def bench_real_fft():
+    pulse=load_reference('squeak.wav')
+    recording,rate=read_wav('squeaks.wav')
+    for name,blockSize in [('sounder',3000),('matfilter',32768)]:
+        length=int(blockSize/2)
+        buffers=recording[:len(recording)//length*length].reshape(-1,length)
+        times={}
+        for real in [False,True]:
+            dsp.realTransforms=real
+            if name == 'sounder':
+                chain=rangeProfile(pulse,blockSize)
+            else:
+                chain=filterBank(8,blockSize)
+                for i in range(0,8):
+                    chain.set_reference(i,pulse)
+            def run():
+                for samples in buffers:
+                    chain.process(samples)
+            times[real]=best_time(run,repeats=3)/len(buffers)
+        dsp.realTransforms=True
+        print('%-12s complex %8.3f ms  real %8.3f ms per buffer  speedup %4.1fx' %
+              (name,times[False]*1000,times[True]*1000,times[False]/times[True]))
+
+# Filter bank throughput against bank size and worker count
+def bench_filter_bank():
+    recording,rate=read_wav('squeaks.wav')
+    buffers=recording[:len(recording)//16384*16384].reshape(-1,16384)[:8]
+    rng=numpy.random.default_rng(0)
+    workers=[1]
+    while workers[-1]*2 <= (os.cpu_count() or 1):
+        workers.append(workers[-1]*2)
+    for filters in [8,100,400]:
+        for count in workers:
+            chain=filterBank(filters,32768,workers=count)
+            chain.ref[:]=numpy.conjugate(chain.plan.forward(rng.standard_normal((filters,1500))))
+            def run():
+                for samples in buffers:
+                    chain.process(samples)
+            elapsed=best_time(run,repeats=3)
+            chain.set_workers(1)
+            print('filter bank %4d filters %2d workers  %10.0f filter-blocks/s' %
+                  (filters,count,filters*len(buffers)/elapsed))
+
+# The per-frame image conversion rdsounder used before render.levelImage
+def legacy_image(plotdat):
+    import cairo
+    data=relative_db(plotdat)
+    data[data<0]=0
+    data[data>255]=255
+    dat=numpy.array(data,dtype=numpy.uint8)
+    dat.shape=(dat.shape[0],dat.shape[1],1)
+    dat=numpy.concatenate((dat,dat,dat,numpy.zeros_like(dat)),axis=2)
+    return cairo.ImageSurface.create_for_data(dat,cairo.FORMAT_ARGB32,dat.shape[1],dat.shape[0])
+
+# Compare range-Doppler image rendering on a map from the bundled recording
+def bench_render():
+    try:
+        import cairo
+    except ImportError:
+        print('render: skipped, cairo is not installed')
+        return
+    recording,rate=read_wav('squeaks.wav')
+    chain=rangeDoppler(load_reference('squeak.wav'),3000)
+    for samples in recording[:len(recording)//1500*1500].reshape(-1,1500)[:200]:
+        chain.process(samples)
+    for width,height in [(512,380),(1500,1000)]:
+        plotdat=chain.image(max(1,1500//width),height)
+        image=levelImage(plotdat.shape[1],plotdat.shape[0],levelMap(relative=True))
+        legacy=best_time(lambda: legacy_image(plotdat),repeats=20)
+        lut=best_time(lambda: image.update(plotdat),repeats=20)
+        print('render %4dx%-4d legacy %8.3f ms  lookup table %8.3f ms  speedup %4.1fx' %
+              (plotdat.shape[1],plotdat.shape[0],legacy*1000,lut*1000,legacy/lut))
+
+# Compare copying captured buffers into fresh arrays against a bufferPool
+#  A memoryview stands in for the mapped GStreamer buffer; bytes() is what
+#  extract_dup did.  Each pooled array is released straight away, as the DSP
+#  worker does once it has processed it.
+def bench_buffer_pool():
+    for frames in [512,1500,16384]:
+        mapped=memoryview(numpy.zeros(frames,dtype=numpy.int16).tobytes())
+        pool=bufferPool(frames)
+        def legacy():
+            for i in range(1000):
+                numpy.frombuffer(bytes(mapped),dtype=numpy.int16)
+        def pooled():
+            for i in range(1000):
+                pool.release(pool.fill(mapped))
+        before=best_time(legacy)/1000
+        after=best_time(pooled)/1000
+        print('buffer %5d frames  extract_dup %6.2f us  pool %6.2f us  %s' %
+              (frames,before*1e6,after*1e6,pool.status()))
+
+# Synthetic echo scene as captured int16 buffers, one transmitted pulse per buffer
+#  Each target is (delay in samples, radial velocity in m/s, amplitude
+#  relative to the pulse); its echo delay drifts from pulse to pulse with
+#  the velocity.  Clutter is a set of fixed random reflectors, and noise is
+#  white with the given standard deviation relative to the pulse peak.
+#  Echoes that run past the end of their buffer are cut off.
+def echo_scene(pulse,length,buffers,targets=[(300,0.0,0.3)],clutter=20,noise=0.01,
+               rate=44100,seed=0):
+    rng=numpy.random.default_rng(seed)
+    pulse=pulse/abs(pulse).max()
+    reflectors=[(rng.uniform(0,length-1),0.0,rng.exponential(0.02)) for i in range(clutter)]
+    scene=noise*rng.standard_normal((buffers,length))
+    scene[:,:min(len(pulse),length)]+=pulse[:length] # Direct path
+    taps=numpy.arange(length)
+    for delay,velocity,amplitude in list(targets)+reflectors:
+        for k in range(buffers):
+            d=delay+2*velocity*k*length/343.0
+            scene[k]+=amplitude*numpy.interp(taps-d,numpy.arange(len(pulse)),pulse,left=0,right=0)
+    return numpy.clip(scene*16000,-32768,32767).astype(numpy.int16)
+
+# Per-buffer processing cost of each tool's stages on synthetic scenes
+#  Returns a list of records with the stage, its parameters, the best time
+#  per buffer and how many times faster than real time that is.
+def bench_suite(targets=[(300,0.0,0.3)],clutter=20,noise=0.01,quick=False,rate=44100):
+    pulse=load_reference('squeak.wav')
+    results=[]
+    def record(stage,params,buffers,func,repeats=3):
+        elapsed=best_time(func,repeats=repeats)/len(buffers)
+        results.append({'stage':stage,'params':params,
+                        'ms_per_buffer':elapsed*1000,
+                        'realtime':buffers.shape[1]/float(rate)/elapsed})
+        print('%-16s %-36s %9.3f ms/buffer %9.0fx real time' %
+              (stage,' '.join('%s=%s' % item for item in params.items()),
+               elapsed*1000,buffers.shape[1]/float(rate)/elapsed))
+    count=20 if quick else 100
+    def scene(blockSize,buffers=count):
+        return echo_scene(pulse,int(blockSize/2),buffers,targets,clutter,noise,rate)
+
+    # sounder: matched filter alone, then pulse averaging
+    for blockSize in ([3000] if quick else [3000,6000,12000]):
+        buffers=scene(blockSize)
+        chain=rangeProfile(pulse,blockSize)
+        chain.averaging=False
+        record('matched filter',{'blockSize':blockSize},buffers,
+               lambda: [chain.process(samples) for samples in buffers])
+    buffers=scene(3000)
+    for window in ([10,100] if quick else [10,100,1000]):
+        history=pulseHistory(window,buffers.shape[1])
+        def run():
+            for samples in buffers:
+                history.push(abs(samples))
+                history.mean()
+        record('averaging',{'blockSize':3000,'window':window},buffers,run)
+
+    # rdsounder: pulse history and range-Doppler map at display size
+    for window in ([100] if quick else [50,100,200]):
+        chain=rangeDoppler(pulse,3000,1,window)
+        def run():
+            for samples in buffers:
+                chain.process(samples)
+                chain.image(3,380)
+        record('doppler',{'blockSize':3000,'window':window},buffers,run)
+        # offline.py reads one map every window pulses
+        chain=rangeDoppler(pulse,3000,1,window)
+        every=min(window,len(buffers)//2)
+        def run():
+            for i,samples in enumerate(buffers):
+                chain.process(samples)
+                if (i+1) % every == 0:
+                    chain.image()
+        record('offline doppler',{'blockSize':3000,'window':window,'every':every},buffers,run)
+
+    # matfilter: filter bank across bank sizes
+    buffers=scene(32768,count//5)
+    rng=numpy.random.default_rng(0)
+    for filters in ([8,100] if quick else [8,100,400]):
+        chain=filterBank(filters,32768)
+        chain.ref[:]=numpy.conjugate(chain.plan.forward(rng.standard_normal((filters,1500))))
+        record('filter bank',{'blockSize':32768,'filters':filters},buffers,
+               lambda: [chain.process(samples) for samples in buffers],repeats=1 if quick else 3)
+
+    # gtkSpec: spectrum and one coloured spectrogram row per buffer
+    for blockSize in ([2048] if quick else [2048,8192,32768]):
+        buffers=scene(blockSize)
+        plan=get_plan(int(blockSize/2))
+        levels=levelMap(scale=40.0,offset=40.0,floor=0.01)
+        row=numpy.zeros(min(plan.bins,511),dtype=numpy.uint32)
+        def run():
+            for samples in buffers:
+                levels.render(plan.forward(samples)[:len(row)],row)
+        record('spectrogram',{'blockSize':blockSize},buffers,run)
+
+    # Multi-channel capture: interleaved buffers deinterleaved as views and
+    # every channel processed in one batch, with one channel on display
+    mono=scene(3000)
+    for channels in ([8] if quick else [2,8,16]):
+        buffers=numpy.repeat(mono[:,:,numpy.newaxis],channels,axis=2) # (buffer,frame,channel)
+        chain=rangeProfile(pulse,3000,1,10,channels)
+        record('channels profile',{'blockSize':3000,'channels':channels},buffers,
+               lambda: [chain.process(deinterleave(samples.reshape(-1),channels)) for samples in buffers])
+        chain=rangeDoppler(pulse,3000,1,100,channels)
+        def run():
+            for samples in buffers:
+                chain.process(deinterleave(samples.reshape(-1),channels))
+                chain.image(3,380,1,1.0,0)
+        record('channels doppler',{'blockSize':3000,'channels':channels},buffers,run)
+        ring=ringBuffer(1024,channels=channels)
+        plan=get_plan(1024)
+        def run():
+            for samples in buffers:
+                ring.write(deinterleave(samples.reshape(-1),channels))
+                plan.forward(ring.view())
+        record('channels spectra',{'blockSize':3000,'channels':channels},buffers,run)
+
+    return results
+
+# Stages that got slower than a baseline by more than tolerance
+def regressions(results,baseline,tolerance):
+    before={(r['stage'],json.dumps(r['params'],sort_keys=True)):r['ms_per_buffer'] for r in baseline}
+    slower=[]
+    for r in results:
+        key=(r['stage'],json.dumps(r['params'],sort_keys=True))
+        if key in before and r['ms_per_buffer'] > before[key]*(1+tolerance):
+            slower.append((r,before[key]))
+    return slower
+
+# Parse a target given as delay:velocity:amplitude
+def target(text):
+    delay,velocity,amplitude=(float(x) for x in text.split(':'))
+    return (delay,velocity,amplitude)
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Benchmark the processing chains without a sound card or display')
+    parser.add_argument('--suite',action='store_true',help='run only the synthetic-echo stage suite')
+    parser.add_argument('--quick',action='store_true',help='fewer buffers and parameter values')
+    parser.add_argument('--target',type=target,action='append',metavar='DELAY:VELOCITY:AMPLITUDE',
+                        help='echo with delay in samples, velocity in m/s (repeat for more)')
+    parser.add_argument('--clutter',type=int,default=20,help='number of fixed clutter reflectors')
+    parser.add_argument('--noise',type=float,default=0.01,help='noise level relative to the pulse peak')
+    parser.add_argument('--json',metavar='FILE',help='write suite results as JSON')
+    parser.add_argument('--compare',metavar='FILE',help='baseline JSON to check for regressions')
+    parser.add_argument('--tolerance',type=float,default=0.25,help='allowed slowdown against the baseline')
+    args=parser.parse_args(argv)
+
+    if not args.suite:
+        bench_wav_load()
+        bench_real_fft()
+        bench_filter_bank()
+        bench_render()
+        bench_buffer_pool()
+
+    results=bench_suite(args.target or [(300,0.0,0.3)],args.clutter,args.noise,args.quick)
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump({'machine':{'platform':platform.platform(),
+                                  'python':platform.python_version(),
+                                  'numpy':numpy.__version__,
+                                  'cpus':os.cpu_count()},
+                       'results':results},f,indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline=json.load(f)['results']
+        slower=regressions(results,baseline,args.tolerance)
+        for r,before in slower:
+            print('REGRESSION %s %s: %0.3f ms/buffer, was %0.3f' %
+                  (r['stage'],r['params'],r['ms_per_buffer'],before))
+        if slower:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
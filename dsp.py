@@ -0,0 +1,625 @@
+#
+# Signal processing building blocks shared by the sonar tools
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import concurrent.futures
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+import scipy.fft
+import scipy.signal
+
+import metrics
+
+# Use half-spectrum real transforms for real input; set False to compare
+# against the full complex transforms
+realTransforms=True
+
+# Transform of a fixed length, either real (rfft/irfft) or complex (fft/ifft)
+#  This only fixes the length and kind of transform; it holds no precomputed
+#  state, scipy.fft keeps its own cache of recent transform sizes.  Spectra
+#  are only compatible with those made by the same length and kind, so the
+#  chains use one fftPlan for their references and every incoming block.
+class fftPlan:
+    def __init__(self,n,real=True):
+        self.n=int(n)
+        self.real=real
+        if real:
+            self.bins=self.n//2+1
+        else:
+            self.bins=self.n
+
+    def forward(self,x,axis=-1):
+        if self.real:
+            return scipy.fft.rfft(x,self.n,axis=axis)
+        else:
+            return scipy.fft.fft(x,self.n,axis=axis)
+
+    def inverse(self,x,axis=-1):
+        if self.real:
+            return scipy.fft.irfft(x,self.n,axis=axis)
+        else:
+            return scipy.fft.ifft(x,self.n,axis=axis)
+
+plans={}
+
+# Shared fftPlan for transforms of length n, so the chains agree on the kind
+def get_plan(n,real=None):
+    if real is None:
+        real=realTransforms
+    key=(int(n),real)
+    if key not in plans:
+        plans[key]=fftPlan(*key)
+    return plans[key]
+
+# Fixed-capacity sample history
+#  Samples are stored twice, at i and i+capacity, so the most recent
+#  capacity samples are always one contiguous slice of the storage and
+#  view() never has to copy or allocate.  With channels, each channel is a
+#  row and samples are written and viewed as (channels,samples) arrays.
+class ringBuffer:
+    def __init__(self,capacity,dtype=numpy.float64,channels=None):
+        self.capacity=int(capacity)
+        shape=() if channels is None else (int(channels),)
+        self.storage=numpy.zeros(shape+(2*self.capacity,),dtype=dtype)
+        self.index=0 # Position of the oldest sample
+        self.written=0 # Total samples written since creation
+
+    # Append new samples, overwriting the oldest
+    def write(self,samples):
+        samples=samples[...,-self.capacity:]
+        n=samples.shape[-1]
+        first=min(n,self.capacity-self.index)
+        self.storage[...,self.index:self.index+first]=samples[...,:first]
+        self.storage[...,self.index+self.capacity:self.index+self.capacity+first]=samples[...,:first]
+        if n > first:
+            self.storage[...,:n-first]=samples[...,first:]
+            self.storage[...,self.capacity:self.capacity+n-first]=samples[...,first:]
+        self.index=(self.index+n) % self.capacity
+        self.written+=n
+
+    # The most recent capacity samples, oldest first, as a read-only view
+    def view(self):
+        result=self.storage[...,self.index:self.index+self.capacity]
+        result.flags.writeable=False
+        return result
+
+    def clear(self):
+        self.storage[...]=0
+        self.index=0
+        self.written=0
+
+# Last window pulses of a fixed length, with their running sum
+#  Pulses are rows of a circular array: adding one overwrites the oldest row
+#  in place and updates the sum, so neither adding nor averaging depends on
+#  the window length.  The sum is recomputed once per lap of the ring to
+#  keep rounding errors from building up.  With channels, each pulse is a
+#  (channels,length) array.
+class pulseHistory:
+    def __init__(self,window,length,dtype=numpy.float64,channels=None):
+        self.window=int(window)
+        self.length=int(length)
+        shape=(self.length,) if channels is None else (int(channels),self.length)
+        self.rows=numpy.zeros((self.window,)+shape,dtype=dtype)
+        self.total=numpy.zeros(shape,dtype=dtype)
+        self.oldest=numpy.zeros(shape,dtype=dtype) # Row pushed out last
+        self.index=self.window-1 # Row of the newest pulse
+        self.pushed=0
+
+    # Add a pulse, rotated left by shift samples, in place of the oldest
+    def push(self,pulse,shift=0):
+        self.index=(self.index+1) % self.window
+        row=self.rows[self.index]
+        self.oldest[...]=row
+        row[...,:self.length-shift]=pulse[...,shift:]
+        row[...,self.length-shift:]=pulse[...,:shift]
+        self.pushed+=1
+        if self.pushed % self.window == 0:
+            self.rows.sum(axis=0,out=self.total)
+        else:
+            self.total-=self.oldest
+            self.total+=row
+        return row
+
+    # Mean over the window, counting pulses not yet received as zero
+    def mean(self):
+        return self.total/self.window
+
+    # Row numbers from the newest pulse to the oldest
+    def order(self):
+        return (self.index-numpy.arange(self.window)) % self.window
+
+    # Copy of the history newest pulse first, optionally of selected samples
+    def ordered(self,columns=slice(None)):
+        return self.rows[...,columns][self.order()]
+
+# Convert magnitudes to the sounders' relative dB scale
+def relative_db(plotdat):
+    plotdat=abs(plotdat)
+    plotdat[plotdat==0]=1e-10
+    dbdat=numpy.log10(plotdat)
+    return 60*dbdat+100-60*numpy.mean(dbdat)
+
+# SNR readout of filter outputs, given correlation magnitudes along the last axis
+def filter_snr(mag,sinr=False):
+    if sinr:
+        return 100*numpy.log10((numpy.max(mag,-1)+0.01)/(numpy.std(mag,-1)+numpy.mean(mag,-1)+0.01))
+    else:
+        return 100*numpy.log10(numpy.max(mag,-1)+0.01)
+
+# Streaming matched filter using overlap-save
+#  Correlates an unbroken sample stream against the whole reference, however
+#  long, keeping the last len(ref)-1 samples between calls.  Every hop new
+#  samples cost one forward and one inverse transform of a fixed length, and
+#  yield hop correlation lags, so each sample is correlated exactly once and
+#  the output is gap-free.  With channels, samples and output are
+#  (channels,samples) arrays and every channel shares the same transforms.
+#  Output sample k is the correlation of the reference with the input
+#  starting len(ref)-1 samples before it.  All the hops completed by one
+#  call are transformed together as the rows of one 2-D array.
+class overlapSave:
+    def __init__(self,ref,hop,scale=1.0,channels=None):
+        self.hop=int(hop)
+        self.overlap=len(ref)-1
+        self.plan=get_plan(scipy.fft.next_fast_len(self.hop+self.overlap,True))
+        self.ref=numpy.conjugate(self.plan.forward(ref))*scale
+        shape=() if channels is None else (int(channels),)
+        self.block=numpy.zeros(shape+(self.plan.n,)) # History followed by new samples
+        self.fill=self.overlap
+
+    # Feed any number of samples, returning the (possibly empty) correlation
+    # output for every hop that they completed
+    def process(self,samples):
+        n=samples.shape[-1]
+        count=(self.fill-self.overlap+n)//self.hop
+        if count == 0:
+            self.block[...,self.fill:self.fill+n]=samples
+            self.fill+=n
+            return self.block[...,:0]
+        if count == 1 and self.fill+n == self.overlap+self.hop:
+            # One hop exactly, the usual case, straight from the block
+            self.block[...,self.fill:self.fill+n]=samples
+            corr=self.plan.inverse(self.plan.forward(self.block)*self.ref)
+            self.block[...,:self.overlap]=self.block[...,self.hop:self.hop+self.overlap]
+            self.fill=self.overlap
+            return corr[...,:self.hop]
+
+        # Each row is a hop of new samples preceded by the overlap before it
+        stream=numpy.concatenate((self.block[...,:self.fill],samples),axis=-1)
+        frames=sliding_window_view(stream,self.overlap+self.hop,axis=-1)[...,::self.hop,:][...,:count,:]
+        corr=self.plan.inverse(self.plan.forward(frames)*self.ref)
+        rest=stream[...,count*self.hop:]
+        self.block[...,:rest.shape[-1]]=rest
+        self.fill=rest.shape[-1]
+        return corr[...,:self.hop].reshape(corr.shape[:-2]+(-1,))
+
+    def reset(self):
+        self.block[...]=0
+        self.fill=self.overlap
+
+# Carry a sample ring across frames missing samples
+#  With fill the missing samples are taken as zeros, keeping later samples in
+#  their true positions; otherwise the stream restarts from silence.
+def skip_stream(frames,samples,fill=True):
+    if fill and frames < samples.capacity:
+        samples.write(numpy.zeros(frames))
+    else:
+        samples.clear()
+
+# Pulse compression of a received stream, cut into pulse repetition intervals
+#  The transmitter repeats its pulse every length samples, so the stream is
+#  sliced into rows on multiples of length samples from its start, and every
+#  pulse in a buffer comes out together, correlated as one batch when
+#  matched.  Lost samples are skipped over without moving the rows out of
+#  step.  The trigger is where the pulse sits within a row: the peak of the
+#  row magnitudes averaged over about 1/triggerGain recent pulses, so it
+#  follows the direct path steadily rather than the strongest sample of
+#  each buffer.  With channels, samples come in as (channels,samples)
+#  arrays, every channel is correlated in the same batch, rows are
+#  (channels,length) and one trigger, from all channels, keeps the delays
+#  between them.
+class pulseCompressor:
+    def __init__(self,ref,length,scale=1.0,channels=None):
+        self.length=int(length)
+        self.shape=() if channels is None else (int(channels),)
+        self.correlator=overlapSave(ref,self.length,scale,channels)
+        self.partial=numpy.zeros(self.shape+(self.length,)) # Raw samples of the unfinished row
+        self.fill=0
+        self.triggerGain=0.1
+        self.reset()
+
+    # Restart the stream from silence at a row boundary
+    def reset(self):
+        self.correlator.reset()
+        self.fill=0
+        self.matched=True
+        self.trigger=numpy.zeros(self.length)
+
+    # Complete pulse repetition intervals of samples, one per row
+    #  Rows hold the matched filter output if matched, otherwise the raw
+    #  samples.  The correlator sits idle while unmatched and restarts from
+    #  silence, in step with the rows, when matching is turned back on.
+    def process(self,samples,matched=True):
+        if matched and not self.matched:
+            self.restart()
+        self.matched=matched
+        raw=self.slice(samples)
+        if not matched:
+            return raw
+        return self.rows(self.correlator.process(samples))
+
+    # Restart the correlator part way through the current row
+    def restart(self):
+        self.correlator.reset()
+        self.correlator.process(numpy.zeros(self.shape+(self.fill,)))
+
+    # Whole rows of a stream as a (rows,[channels,]length) view
+    def rows(self,stream):
+        count=stream.shape[-1]//self.length
+        rows=stream[...,:count*self.length].reshape(self.shape+(count,self.length))
+        return numpy.moveaxis(rows,-2,0)
+
+    def slice(self,samples):
+        samples=numpy.asarray(samples)
+        if self.fill == 0 and samples.shape[-1] % self.length == 0:
+            return self.rows(samples)
+        stream=numpy.concatenate((self.partial[...,:self.fill],samples),axis=-1)
+        count=stream.shape[-1]//self.length
+        self.fill=stream.shape[-1]-count*self.length
+        self.partial[...,:self.fill]=stream[...,count*self.length:]
+        return self.rows(stream)
+
+    # Carry the row timing over frames lost samples
+    #  The correlator restarts from silence, but the stream position moves
+    #  on by frames so later rows stay in step with the pulses.
+    def skip(self,frames):
+        start=self.fill
+        self.fill=(start+frames) % self.length
+        if start+frames < self.length:
+            self.partial[...,start:self.fill]=0
+        else:
+            self.partial[...,:self.fill]=0
+        self.restart()
+
+    # Trigger position after taking in a batch of row magnitudes
+    def locate(self,mags):
+        if len(mags):
+            weight=1-(1-self.triggerGain)**len(mags)
+            self.trigger+=weight*(mags.mean(axis=tuple(range(mags.ndim-1)))-self.trigger)
+        return int(numpy.argmax(self.trigger))
+
+# Matched-filter range profiles with optional centering and averaging (sounder)
+#  With channels, buffers are (channels,samples) arrays and profiles are
+#  (channels,length), all channels processed together.
+class rangeProfile:
+    def __init__(self,ref,blockSize,blocks=1,averagingWindow=10,channels=None):
+        self.channels=channels
+        self.length=int(blockSize/2*blocks)
+        self.front=pulseCompressor(ref,self.length,4.0/blockSize**2,channels)
+        self.matched=True
+        self.averaging=True
+        self.centering=True
+        self.metrics=metrics.disabled # Stage timers; see metrics.stageMetrics
+        self.reset(averagingWindow)
+
+    # Clear the averaging history, optionally changing its length
+    def reset(self,averagingWindow=None):
+        if averagingWindow is not None:
+            self.averagingWindow=averagingWindow
+        self.history=pulseHistory(self.averagingWindow,self.length,channels=self.channels)
+        self.profile=numpy.zeros(self.history.total.shape)
+
+    # Averaging history, one pulse per column with the newest first, or
+    # the latest profile when not averaging
+    @property
+    def corr_data(self):
+        if self.averaging:
+            return self.history.ordered().T
+        return self.profile
+
+    # Account for frames samples lost before the next buffer
+    #  With fill, each lost pulse is averaged in as silence; otherwise the
+    #  averaging starts over.
+    def skip(self,frames,fill=True):
+        if not fill:
+            self.front.reset()
+            self.reset()
+            return
+        if frames <= self.length*self.averagingWindow:
+            self.process(numpy.zeros(self.front.shape+(frames,)))
+            return
+        self.front.skip(frames)
+        for i in range(0,min(int(round(frames/float(self.length))),self.averagingWindow)):
+            self.history.push(numpy.zeros_like(self.history.total))
+
+    # Take in a buffer of any number of samples and return the current range
+    # profile, after averaging in every pulse the buffer completed
+    def process(self,samples):
+        with self.metrics.stage('correlate'):
+            # Correlate against chirp reference, continuously across buffers
+            pulses=self.front.process(samples,self.matched)
+            mags=abs(pulses)
+
+            # Trigger if desired
+            if self.centering:
+                idx=self.front.locate(mags)
+            else:
+                idx=0
+
+        # Align pulses
+        with self.metrics.stage('average'):
+            if self.averaging:
+                for pulse in mags:
+                    self.history.push(pulse,idx)
+                return self.history.mean()
+            else:
+                if len(pulses):
+                    self.profile=numpy.roll(pulses[-1],-idx,axis=-1)
+                return self.profile
+
+# Matched-filter pulse history and range-Doppler maps (rdsounder)
+#  Only the displayed part of the slow-time spectrum is computed: the
+#  requested Doppler rows on the range gates that survive decimation.  It
+#  is kept up to date with a sliding DFT generalized to arbitrary
+#  frequencies, so each new pulse costs O(rows) per gate, and is recomputed
+#  from the history with a chirp-Z transform whenever the view changes and
+#  every resyncInterval pulses to stop rounding errors accumulating.  It
+#  only slides while the map is read after every buffer; callers reading
+#  it less often get it rebuilt by the chirp-Z transform instead.  With
+#  channels, buffers are (channels,samples) arrays, and history rows and
+#  images gain a channel axis before the range gates.
+class rangeDoppler:
+    def __init__(self,ref,blockSize,blocks=1,averagingWindow=100,channels=None):
+        self.channels=channels
+        self.length=int(blockSize/2*blocks)
+        self.front=pulseCompressor(ref,self.length,4.0/blockSize**2,channels)
+        self.matched=True
+        self.doppler=True
+        self.centering=True
+        self.resyncInterval=1000
+        self.metrics=metrics.disabled # Stage timers; see metrics.stageMetrics
+        self.view=None
+        self.reset(averagingWindow)
+
+    # Clear the pulse history, optionally changing its length
+    def reset(self,averagingWindow=None):
+        if averagingWindow is not None:
+            self.averagingWindow=averagingWindow
+        self.history=pulseHistory(self.averagingWindow,self.length,channels=self.channels)
+        self.spectrum=None
+        self.read=False # Whether image was called since the last buffer
+
+    # Pulse history, one pulse per row with the newest first
+    @property
+    def corr_data(self):
+        return self.history.ordered()
+
+    # Account for frames samples lost before the next buffer
+    #  With fill, each lost pulse enters the history as silence, keeping the
+    #  slow-time sampling of later pulses regular; otherwise the history
+    #  starts over.
+    def skip(self,frames,fill=True):
+        if not fill:
+            self.front.reset()
+            self.reset()
+            return
+        if frames <= self.length*self.averagingWindow:
+            self.process(numpy.zeros(self.front.shape+(frames,)))
+            return
+        self.front.skip(frames)
+        for i in range(0,min(int(round(frames/float(self.length))),self.averagingWindow)):
+            self.add(numpy.zeros_like(self.history.total))
+        self.read=False
+
+    # Choose the displayed part of the range-Doppler map
+    #  Every step-th range gate; every rowstep-th of rows Doppler rows spread
+    #  over span cycles per pulse with zero Doppler in the middle row.  The
+    #  default is every bin of a full slow-time DFT.  With channels, the map
+    #  covers one channel, or all of them if channel is None; following just
+    #  the one on display keeps the sliding DFT at single-channel cost.
+    def set_view(self,step=1,rows=None,rowstep=1,span=1.0,channel=None):
+        if rows is None:
+            rows=self.averagingWindow
+        view=(step,rows,rowstep,span,self.averagingWindow,channel)
+        if view == self.view:
+            return
+        self.view=view
+        self.gates=numpy.arange(0,self.length,step)
+        if channel is None:
+            self.select=(Ellipsis,self.gates)
+        else:
+            self.select=(channel,self.gates)
+
+        # Row i shows frequency span*(i-rows//2)/rows of the newest-first
+        # history, which is the negated frequency of the oldest-first history
+        self.start=span*(rows//2)/float(rows)
+        self.delta=-span*rowstep/float(rows)
+        freqs=self.start+self.delta*numpy.arange(len(range(0,rows,rowstep)))
+        freqs=freqs.reshape((-1,)+(1,)*self.history.rows[(0,)+self.select].ndim) # Broadcast over [channels,]gates
+        self.rotate=numpy.exp(2j*numpy.pi*freqs)
+        self.newest=numpy.exp(-2j*numpy.pi*freqs*(self.averagingWindow-1))
+        self.spectrum=None
+
+    # Recompute the displayed spectrum from the history, oldest pulse first
+    def resync(self):
+        self.spectrum=scipy.signal.czt(self.history.rows[(slice(None),)+self.select][self.history.order()[::-1]],
+                                       len(self.rotate),
+                                       numpy.exp(-2j*numpy.pi*self.delta),
+                                       numpy.exp(2j*numpy.pi*self.start),axis=0)
+        self.updates=0
+
+    # Slide the displayed spectrum along by one pulse
+    def slide(self,oldest,newest):
+        if self.spectrum is None or self.updates >= self.resyncInterval:
+            self.resync()
+        else:
+            self.spectrum-=oldest[self.select]
+            self.spectrum*=self.rotate
+            self.spectrum+=self.newest*newest[self.select]
+            self.updates+=1
+
+    # Take in a buffer of any number of samples and push every aligned pulse
+    # it completed into the history
+    def process(self,samples):
+        with self.metrics.stage('correlate'):
+            # Correlate against chirp reference, continuously across buffers
+            pulses=self.front.process(samples,self.matched)
+            mags=abs(pulses)
+
+            # Trigger if desired
+            if self.centering:
+                idx=self.front.locate(mags)
+            else:
+                idx=0
+
+        with self.metrics.stage('doppler'):
+            for pulse in mags:
+                self.add(pulse,idx)
+            self.read=False
+
+    # Push an aligned pulse into the history
+    def add(self,pulse,shift=0):
+        newest=self.history.push(pulse,shift)
+
+        # Keep the Doppler spectrum current only while it is read after every
+        # buffer, as the live display does; otherwise image rebuilds it
+        if self.doppler and self.view is not None and self.read:
+            self.slide(self.history.oldest,newest)
+        else:
+            self.spectrum=None
+
+    # Range-time history, or range-Doppler map if enabled, for a view as
+    # described in set_view
+    def image(self,step=1,rows=None,rowstep=1,span=1.0,channel=None):
+        if not self.doppler:
+            history=self.history.ordered(slice(None,None,step))[::rowstep]
+            return history if channel is None else history[:,channel]
+        self.set_view(step,rows,rowstep,span,channel)
+        if self.spectrum is None:
+            self.resync()
+        self.read=True
+        return self.spectrum
+
+# Bank of matched filters with SNR readouts (matfilter)
+#  The bank is evaluated in chunks of filters, which bounds the size of the
+#  intermediate arrays for large banks.  With more than one worker the
+#  chunks are spread over a thread pool; the transforms and array
+#  arithmetic release the GIL, so the chunks run on separate cores.
+class filterBank:
+    def __init__(self,filters,blockSize,blocks=1,traces=4,workers=1):
+        self.filters=filters
+        self.traces=traces
+        self.length=int(blockSize/2*blocks)
+        self.samples=ringBuffer(self.length)
+        self.plan=get_plan(self.length)
+        self.ref=numpy.zeros((self.filters,self.plan.bins),dtype='complex128') # One row per filter
+        self.snrs=numpy.zeros(self.filters)
+        self.averaging=False
+        self.centering=False
+        self.sinr=False
+        self.metrics=metrics.disabled # Stage timers; see metrics.stageMetrics
+        self.pool=None
+        self.set_workers(workers)
+        self.reset()
+
+    # Change the number of threads evaluating the bank
+    def set_workers(self,workers):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool=None
+        self.workers=max(1,int(workers))
+        if self.workers > 1:
+            self.pool=concurrent.futures.ThreadPoolExecutor(self.workers,thread_name_prefix='bank')
+
+        # Split the bank evenly over the workers, at most 64 filters at a time
+        chunk=max(1,min(64,-(-self.filters//self.workers)))
+        self.chunks=[(lo,min(lo+chunk,self.filters)) for lo in range(0,self.filters,chunk)]
+
+    # Clear the averaged correlation traces
+    def reset(self):
+        self.corr_data=[]
+        for i in range(0,self.traces):
+            if self.plan.real:
+                self.corr_data.append(numpy.zeros(self.length))
+            else:
+                self.corr_data.append(numpy.zeros(self.length,dtype='complex128'))
+
+    # Account for frames samples lost before the next buffer
+    #  With fill the missing samples are zeros; otherwise the block and the
+    #  averaged traces start over.
+    def skip(self,frames,fill=True):
+        skip_stream(frames,self.samples,fill=fill)
+        if not fill:
+            self.reset()
+
+    # Use a signal as the reference for filter i
+    def set_reference(self,i,wavdata):
+        self.ref[i]=numpy.conjugate(self.plan.forward(wavdata))
+
+    # Use the most recent samples as the reference for filter i
+    def capture(self,i):
+        self.ref[i]=numpy.conjugate(self.plan.forward(self.samples.view()))
+
+    # Correlate filters lo to hi-1 against a block spectrum, filling in their
+    # SNRs and returning the correlations and magnitudes of any traced filters
+    def evaluate(self,data_fft,lo,hi):
+        corr=self.plan.inverse(data_fft*self.ref[lo:hi])
+        mag=numpy.abs(corr)
+        self.snrs[lo:hi]=filter_snr(mag,self.sinr)
+        keep=max(0,min(hi,self.traces)-lo)
+        return corr[:keep],mag[:keep]
+
+    # Take in one buffer of samples and return the SNR of each filter, the
+    # strongest filter (or -1) and the correlation traces of the first filters
+    def process(self,samples):
+        with self.metrics.stage('correlate'):
+            self.samples.write(samples)
+            data_fft=self.plan.forward(self.samples.view())
+
+            if self.pool is None:
+                results=[self.evaluate(data_fft,lo,hi) for lo,hi in self.chunks]
+            else:
+                results=list(self.pool.map(lambda chunk: self.evaluate(data_fft,*chunk),self.chunks))
+            corr=numpy.concatenate([result[0] for result in results])
+            mag=numpy.concatenate([result[1] for result in results])
+            snrs=self.snrs.copy()
+
+        # Detect maximum filter readout
+        maxnum=int(numpy.argmax(snrs))
+        if not snrs[maxnum] > 0:
+            maxnum=-1
+
+        # Keep traces of the first few filters
+        with self.metrics.stage('average'):
+            traces=len(corr)
+            if self.centering:
+                idx=numpy.argmax(mag,1)
+            else:
+                idx=numpy.zeros(traces,dtype=int)
+            for i in range(0,traces):
+                if self.averaging:
+                    self.corr_data[i][0:numpy.size(self.corr_data[i],0)-idx[i]]+=corr[i,idx[i]:]
+                else:
+                    self.corr_data[i]=corr[i,idx[i]:]
+
+        return (snrs,maxnum,self.corr_data)
@@ -0,0 +1,615 @@
+#
+# Processing engine that runs the DSP chain off the GTK main loop
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import os
+import queue
+import threading
+import time
+import traceback
+import numpy
+
+import wavio
+
+# Reusable arrays for captured samples
+#  fill copies a mapped GStreamer buffer into an array from the pool, which
+#  is the only copy a buffer needs.  Each array has one user when filled;
+#  hold adds another (for example the recorder) and release gives one up,
+#  the array going back to the pool when the last user is done.  The pool
+#  grows on demand and the counters show how often it had to: after warming
+#  up there should be no allocations per buffer.
+class bufferPool:
+    def __init__(self,frames=None,count=32,dtype=numpy.int16):
+        self.dtype=numpy.dtype(dtype)
+        self.free={}
+        self.users={}
+        self.lock=threading.Lock()
+        self.buffers=0
+        self.copies=0
+        self.allocations=0
+        if frames is not None:
+            self.free[int(frames)]=[numpy.zeros(int(frames),dtype=self.dtype) for i in range(count)]
+
+    def fill(self,data):
+        source=numpy.frombuffer(data,dtype=self.dtype)
+        with self.lock:
+            free=self.free.get(len(source))
+            if free:
+                array=free.pop()
+            else:
+                array=numpy.zeros(len(source),dtype=self.dtype)
+                self.allocations+=1
+            self.users[id(array)]=[array,1]
+            self.buffers+=1
+            self.copies+=1
+            if isinstance(data,bytes): # Older PyGObject maps into a bytes copy
+                self.copies+=1
+        array[:]=source
+        return array
+
+    def hold(self,array):
+        with self.lock:
+            entry=self.users.get(id(array))
+            if entry is not None:
+                entry[1]+=1
+
+    # Give up one use of an array; arrays not from the pool are ignored
+    def release(self,array):
+        with self.lock:
+            entry=self.users.get(id(array))
+            if entry is None or entry[0] is not array:
+                return
+            entry[1]-=1
+            if entry[1] == 0:
+                del self.users[id(array)]
+                self.free.setdefault(len(array),[]).append(array)
+
+    # One-line summary for a status label
+    def status(self):
+        per=max(self.buffers,1)
+        return 'Pool %d buffers  %0.1f copies/buffer  %d allocations (%0.3f/buffer)' % (
+            self.buffers,self.copies/float(per),self.allocations,self.allocations/float(per))
+
+# Runs a processing function over every captured buffer on its own thread
+#  buffer_cb hands buffers over through a bounded queue and never blocks; if
+#  the queue is full the buffer is dropped and counted.  Each result replaces
+#  latest in a single reference assignment, so the draw callback always sees a
+#  complete result without taking a lock.  UI callbacks that change processing
+#  state should hold lock while they do so.
+#  Samples missing before a buffer, whether lost before it was captured or
+#  dropped here, are passed to gap (if given) on the worker thread just
+#  before the buffer is processed, so the processing can account for them.
+#  A buffer submitted with restart follows a break in the stream, such as a
+#  replay seek, and restart (if given) is called instead so the processing
+#  can start over.  Buffers from a bufferPool are released once processed or dropped.  Each
+#  buffer can carry the perf_counter time it was captured, and displayed
+#  turns that into the capture-to-display latency of the latest result.
+#  Buffers of interleaved channels count lost samples in frames of all
+#  channels.  An exception processing one buffer is printed and counted, and
+#  the worker carries on with the next.
+class dspWorker(threading.Thread):
+    def __init__(self,process,depth=20,gap=None,pool=None,channels=1,restart=None):
+        threading.Thread.__init__(self,name='dsp',daemon=True)
+        self.process=process
+        self.gap=gap
+        self.restart=restart
+        self.pool=pool
+        self.channels=channels
+        self.pending=0 # Samples dropped since the last queued buffer
+        self.pendingRestart=False # A dropped buffer followed a break
+        self.queue=queue.Queue(depth)
+        self.depth=depth
+        self.lock=threading.Lock()
+        self.latest=None
+        self.stamp=None # Capture time of the latest result
+        self.shown=None # Capture time of the result last displayed
+        self.processed=0
+        self.dropped=0
+        self.errors=0
+        self.maxQueued=0
+
+    # Hand a buffer to the worker (called from the GStreamer streaming thread)
+    #  Sources that can wait, such as replays, set block to be held back
+    #  instead of dropping buffers.  gap is the number of samples missing
+    #  just before this buffer, and stamp the time its newest sample was
+    #  captured (default now).  restart marks a break in the stream just
+    #  before this buffer.
+    def submit(self,samples,block=False,gap=0,stamp=None,restart=False):
+        if stamp is None:
+            stamp=time.perf_counter()
+        restart=restart or self.pendingRestart
+        try:
+            self.queue.put((samples,self.pending+gap,stamp,restart),block)
+        except queue.Full:
+            self.dropped+=1
+            self.pending+=gap+len(samples)//self.channels
+            self.pendingRestart=restart
+            if self.pool is not None:
+                self.pool.release(samples)
+            return False
+        self.pending=0
+        self.pendingRestart=False
+        queued=self.queue.qsize()
+        if queued > self.maxQueued:
+            self.maxQueued=queued
+        return True
+
+    def run(self):
+        while True:
+            item=self.queue.get()
+            if item is None:
+                break
+            samples,gap,stamp,restart=item
+            try:
+                with self.lock:
+                    if restart:
+                        if self.restart is not None:
+                            self.restart()
+                    elif gap and self.gap is not None:
+                        self.gap(gap)
+                    result=self.process(samples)
+            except Exception:
+                traceback.print_exc()
+                self.errors+=1
+                result=None
+            finally:
+                if self.pool is not None:
+                    self.pool.release(samples)
+            self.processed+=1
+            if result is not None:
+                self.stamp=stamp
+                self.latest=result
+
+    def stop(self):
+        self.queue.put(None)
+
+    # Seconds from capture to now for the latest result, the first time it
+    # is displayed (called from the draw callback), otherwise None
+    def displayed(self):
+        stamp=self.stamp
+        if stamp is None or stamp == self.shown:
+            return None
+        self.shown=stamp
+        return time.perf_counter()-stamp
+
+    # One-line summary of the counters for a status label
+    def status(self):
+        return 'Queue %d/%d (max %d)  Processed %d  Dropped %d  Errors %d' % (
+            self.queue.qsize(),self.depth,self.maxQueued,self.processed,self.dropped,self.errors)
+
+# Cuts captured buffers of any size into processing frames
+#  The capture block size sets how often data arrives, the frame length how
+#  much each transform sees; hop is the number of samples between the
+#  starts of successive frames, at most the frame length, so frames overlap
+#  when it is shorter.  submit takes the same arguments as dspWorker.submit
+#  and hands each completed frame on to the worker, stamped with the time
+#  its newest sample was captured (given stamps are perf_counter times of
+#  the newest sample of each buffer).  A buffer that is exactly one frame, when
+#  hop is the frame length and nothing is part-assembled, is passed straight
+#  through; otherwise frames are copied into arrays from pool (if given) and
+#  the captured buffer is released.  A gap restarts assembly: the missing
+#  samples and any not yet in a frame are reported with the next frame.  A
+#  restart drops any part-assembled frame and is passed on with the next.
+#  With more than one channel, buffers hold interleaved samples and frames,
+#  hop and gaps count samples per channel.
+class frameAssembler:
+    def __init__(self,worker,frames,hop=None,rate=None,pool=None,dtype=numpy.int16,channels=1):
+        self.worker=worker
+        self.channels=channels
+        if not 0 < int(hop or frames) <= int(frames):
+            raise ValueError('hop must be between 1 and the frame length')
+        self.frames=int(frames)*channels # Interleaved samples per frame
+        self.hop=int(hop or frames)*channels
+        self.rate=rate*channels if rate else rate # For stamping frames cut from one buffer
+        self.pool=pool
+        self.data=numpy.zeros(2*self.frames,dtype=dtype)
+        self.fill=0 # Samples held
+        self.fresh=0 # Samples held that have not been in a frame yet
+        self.gap=0 # Samples lost since the last frame
+        self.restart=False # Next frame follows a break in the stream
+
+    def submit(self,samples,block=False,gap=0,stamp=None,restart=False):
+        if stamp is None:
+            stamp=time.perf_counter()
+        if restart:
+            self.restart=True
+            self.gap=0
+            self.fill=0
+            self.fresh=0
+        elif gap:
+            self.gap+=gap+self.fresh//self.channels
+            self.fill=0
+            self.fresh=0
+
+        if self.fill == 0 and len(samples) == self.frames and self.hop == self.frames:
+            gap,self.gap=self.gap,0
+            restart,self.restart=self.restart,False
+            return self.worker.submit(samples,block,gap,stamp,restart)
+
+        count=len(samples)
+        if self.fill+count > len(self.data):
+            data=numpy.zeros(self.fill+count+self.frames,dtype=self.data.dtype)
+            data[:self.fill]=self.data[:self.fill]
+            self.data=data
+        self.data[self.fill:self.fill+count]=samples
+        self.fill+=count
+        self.fresh+=count
+        if self.pool is not None:
+            self.pool.release(samples)
+
+        start=0
+        ok=True
+        while self.fill-start >= self.frames:
+            frame=self.data[start:start+self.frames]
+            frame=self.pool.fill(frame) if self.pool is not None else frame.copy()
+            # Capture time of the frame's newest sample, going back from the
+            # newest sample held
+            end=(self.fill-start-self.frames)/float(self.rate) if self.rate else 0.0
+            gap,self.gap=self.gap,0
+            restart,self.restart=self.restart,False
+            ok=self.worker.submit(frame,block,gap,stamp-end,restart) and ok
+            start+=self.hop
+            self.fresh=max(self.fill-start-self.frames+self.hop,0)
+        if start:
+            self.data[:self.fill-start]=self.data[start:self.fill]
+            self.fill-=start
+        return ok
+
+# Split interleaved multi-channel samples into a (channels,frames) view
+#  The rows are strided views of the captured buffer, not copies; a single
+#  channel comes back as it is.
+def deinterleave(samples,channels=1):
+    if channels == 1:
+        return samples
+    return samples.reshape(-1,channels).T
+
+# perf_counter time at which the newest sample of a buffer was captured
+#  running is the pipeline's running time now (clock time less base time)
+#  and pts and duration the buffer's, all in nanoseconds with 2**64-1 for
+#  none.  Without them the buffer is taken to have just been captured.
+def capture_stamp(running,pts,duration):
+    now=time.perf_counter()
+    none=2**64-1
+    if running is None or pts == none or duration == none:
+        return now
+    return now-max(running-(pts+duration),0)/1e9
+
+# Checks that captured buffers follow on from each other without gaps
+#  Each buffer is expected to start where the previous one ended, going by
+#  its sample offset when the source sets one, or else by its PTS, allowing
+#  tolerance samples of timestamp jitter.  Missing samples (a source
+#  overrun, or buffers dropped upstream) and overlaps are counted, and the
+#  most recent gaps are kept as (PTS in seconds, samples) pairs.
+#  Timestamps and offsets are in GStreamer units, with 2**64-1 for none.
+class continuityTracker:
+    def __init__(self,rate,tolerance=None,history=10):
+        self.rate=rate
+        self.tolerance=int(rate*0.002) if tolerance is None else tolerance
+        self.history=history
+        self.reset()
+
+    def reset(self):
+        self.nextOffset=None
+        self.nextPts=None
+        self.buffers=0
+        self.gaps=0
+        self.missing=0
+        self.overlaps=0
+        self.discontinuities=0
+        self.recent=[]
+
+    # Check one buffer of frames samples, returning how many samples are
+    # missing before it
+    def check(self,pts,duration,offset,frames,discont=False):
+        none=2**64-1
+        gap=0
+        if offset != none and self.nextOffset is not None:
+            gap=offset-self.nextOffset
+        elif pts != none and self.nextPts is not None:
+            gap=int(round((pts-self.nextPts)*self.rate/1e9))
+            if abs(gap) <= self.tolerance:
+                gap=0
+
+        self.nextOffset=offset+frames if offset != none else None
+        if pts != none:
+            if duration == none:
+                duration=int(frames*1e9/self.rate)
+            self.nextPts=pts+duration
+        else:
+            self.nextPts=None
+
+        if discont and self.buffers > 0:
+            self.discontinuities+=1
+        self.buffers+=1
+        if gap > 0:
+            self.gaps+=1
+            self.missing+=gap
+            self.recent=(self.recent+[(pts/1e9 if pts != none else None,gap)])[-self.history:]
+            return gap
+        if gap < 0:
+            self.overlaps+=1
+        return 0
+
+    # One-line summary for a status label
+    def status(self):
+        text='Gaps %d (%d samples)  Overlaps %d  Discont %d' % (self.gaps,self.missing,
+                                                              self.overlaps,self.discontinuities)
+        if self.recent and self.recent[-1][0] is not None:
+            text+='  Last at %0.1f s' % self.recent[-1][0]
+        return text
+
+# Streams every captured buffer to disk on its own thread
+#  Samples go to a 16-bit PCM WAV file and buffer timestamps to a .pts file
+#  beside it (see wavio.read_capture); both can be memory-mapped while the
+#  capture is still growing.  Buffers are gathered into chunks of about
+#  chunk frames, and the WAV header is rewritten after each chunk, so an
+#  interrupted session loses at most one chunk.  As with dspWorker, submit
+#  never blocks and the queue depth bounds memory use; a full queue drops
+#  and counts the buffer.  With append set, an existing capture of the same
+#  format is extended instead of replaced.  WAV sizes limit a capture to
+#  4 GB, about 13 hours of mono audio at 44.1 kHz.
+class captureRecorder(threading.Thread):
+    def __init__(self,filename,rate,channels=1,depth=1000,chunk=None,append=False,pool=None):
+        threading.Thread.__init__(self,name='recorder',daemon=True)
+        self.filename=filename
+        self.pool=pool # Buffers are released to it once written
+        self.rate=rate
+        self.channels=channels
+        self.queue=queue.Queue(depth)
+        self.depth=depth
+        self.chunk=chunk or rate
+        self.frames=0 # Frames on disk
+        self.buffers=0
+        self.dropped=0
+        self.maxQueued=0
+        self.full=False
+        self.stopped=False # Set under lock, so nothing is queued after the sentinel
+        self.lock=threading.Lock()
+
+        if append and os.path.exists(filename):
+            self.data=open(filename,'r+b')
+            tag,channels,rate,width,offset,length=wavio.read_header(self.data)
+            if (tag,channels,rate,width,offset) != (wavio.WAVE_FORMAT_PCM,self.channels,
+                                                    self.rate,2,wavio.HEADER_LENGTH):
+                self.data.close()
+                raise ValueError(filename + ' is not a capture in the same format')
+            self.frames=length//(2*channels)
+            self.data.truncate(offset+self.frames*2*channels)
+            self.data.seek(0,os.SEEK_END)
+            self.index=open(filename+'.pts','ab')
+        else:
+            self.data=open(filename,'wb')
+            wavio.write_header(self.data,rate,channels)
+            self.index=open(filename+'.pts','wb')
+
+    # Hand a buffer of int16 samples and its PTS to the recorder (called from
+    # the GStreamer streaming thread)
+    #  Buffers arriving once stop has been called are released unwritten.
+    def submit(self,samples,pts=None):
+        with self.lock:
+            if not self.stopped:
+                try:
+                    self.queue.put_nowait((samples,pts))
+                except queue.Full:
+                    self.dropped+=1
+                else:
+                    queued=self.queue.qsize()
+                    if queued > self.maxQueued:
+                        self.maxQueued=queued
+                    return True
+        if self.pool is not None:
+            self.pool.release(samples)
+        return False
+
+    def run(self):
+        pending=[]
+        records=[]
+        frames=0
+        while True:
+            item=self.queue.get()
+            if item is None:
+                break
+            samples,pts=item
+            count=len(samples)//self.channels
+            if 2*self.channels*(self.frames+frames+count)+36 > 0xFFFFFFFF:
+                self.full=True
+                self.dropped+=1
+                if self.pool is not None:
+                    self.pool.release(samples)
+                continue
+            records.append((self.frames+frames,2**64-1 if pts is None else pts))
+            pending.append(samples)
+            frames+=count
+            if frames >= self.chunk:
+                self.write(pending,records,frames)
+                pending,records,frames=[],[],0
+        self.write(pending,records,frames)
+        self.data.close()
+        self.index.close()
+
+    # Append a chunk of buffers and make the header cover it
+    def write(self,pending,records,frames):
+        for samples in pending:
+            self.data.write(numpy.ascontiguousarray(samples,dtype='<i2'))
+            if self.pool is not None:
+                self.pool.release(samples)
+        self.index.write(numpy.array(records,dtype=wavio.PTS_DTYPE))
+        self.frames+=frames
+        self.buffers+=len(records)
+
+        self.data.seek(0)
+        wavio.write_header(self.data,self.rate,self.channels,2,self.frames*2*self.channels)
+        self.data.seek(0,os.SEEK_END)
+        self.data.flush()
+        self.index.flush()
+
+    # Finish writing everything queued so far and close the files
+    def stop(self):
+        with self.lock:
+            self.stopped=True
+        self.queue.put(None)
+        self.join()
+
+    # One-line summary for a status label
+    def status(self):
+        return 'Recording %s  %0.1f s  Queue %d/%d (max %d)  Dropped %d%s' % (
+            self.filename,self.frames/float(self.rate),self.queue.qsize(),self.depth,
+            self.maxQueued,self.dropped,'  FULL' if self.full else '')
+
+# Endless train of transmit pulses for an appsrc
+#  The pulse is zero-padded to period samples, and a chunk of whole periods
+#  lasting about chunk samples is built once.  next returns that same chunk
+#  every time along with the sample offset it starts at, so buffers can be
+#  timestamped exactly and the train has no seams or restarts.  reference
+#  is the pulse itself as floats, for the matched filter, so the receiver
+#  correlates against exactly what is sent.
+class pulseTrain:
+    def __init__(self,pulse,period=None,rate=44100,chunk=None):
+        pulse=numpy.asarray(pulse)
+        self.period=int(period or len(pulse))
+        if len(pulse) > self.period:
+            raise ValueError('pulse is longer than its period')
+        self.rate=rate
+        self.pulse=numpy.clip(numpy.round(pulse),-32768,32767).astype('<i2')
+        periods=max(-(-int(chunk or rate//10)//self.period),1)
+        train=numpy.zeros(self.period,dtype='<i2')
+        train[:len(self.pulse)]=self.pulse
+        self.frames=periods*self.period # Samples per chunk
+        self.chunk=numpy.tile(train,periods).tobytes()
+        self.offset=0 # Sample offset of the next chunk
+
+    def reference(self):
+        return self.pulse.astype(numpy.float64)
+
+    # Next chunk of S16LE bytes and its starting sample offset
+    def next(self):
+        offset=self.offset
+        self.offset+=self.frames
+        return self.chunk,offset
+
+    # GStreamer time in nanoseconds of a sample offset
+    def time(self,offset):
+        return offset*1000000000//self.rate
+
+# Feeds a recording to a dspWorker as if it were being captured live
+#  The recording is memory-mapped, so it can be any length, and is cut into
+#  buffers of frames samples like the ones pulsesrc delivers.  worker can
+#  also be a frameAssembler, to cut them up as a live capture would be.  speed is a
+#  multiple of real time, or 0 to go as fast as the worker can process;
+#  buffers are never dropped, the replay waits for the worker instead.
+#  Captures written by captureRecorder seek to the buffer containing the
+#  requested PTS through their .pts index, other recordings go straight to
+#  the frame.  Replay pauses at the end of the recording.  The first buffer
+#  after a seek or the end is submitted with restart, so the processing
+#  does not join audio from either side of the jump.  channel picks one channel of a
+#  multi-channel recording; None replays them all, interleaved as captured,
+#  with frames counting samples of every channel.  Samples of any width are
+#  scaled to int16 as they are sent.  With rate given the recording must be
+#  sampled at that rate, and with channels given it must have that many
+#  channels once channel is picked.
+class replaySource(threading.Thread):
+    def __init__(self,filename,worker,frames,speed=1.0,channel=0,rate=None,channels=None):
+        threading.Thread.__init__(self,name='replay',daemon=True)
+        if os.path.exists(filename+'.pts'):
+            data,self.rate,self.index=wavio.read_capture(filename)
+        else:
+            data,self.rate=wavio.read_wav(filename)
+            self.index=numpy.zeros(0,dtype=wavio.PTS_DTYPE)
+        if rate is not None and self.rate != rate:
+            raise ValueError('%s is sampled at %d Hz, not %d Hz' % (filename,self.rate,rate))
+        with open(filename,'rb') as f:
+            self.width=wavio.read_header(f)[3]
+        if data.ndim > 1 and channel is not None:
+            data=data[:,channel]
+        self.channels=data.shape[1] if data.ndim > 1 else 1
+        if channels is not None and self.channels != channels:
+            raise ValueError('%s has %d channels, not %d' % (filename,self.channels,channels))
+        self.data=data
+        self.worker=worker
+        self.frames=int(frames)//self.channels
+        self.speed=speed
+        self.position=0 # Next frame to send
+        self.lock=threading.Lock()
+        self.paused=False
+        self.playing=threading.Event() # Clear while paused or at the end
+        self.playing.set()
+        self.restart=True # Pacing clock needs re-anchoring
+        self.jumped=False # Stream broken since the last buffer sent
+
+    def duration(self):
+        return len(self.data)/float(self.rate)
+
+    # Replay position in seconds
+    def time(self):
+        return self.position/float(self.rate)
+
+    def seek(self,seconds):
+        if len(self.index) and self.index['pts'][0] != 2**64-1:
+            pts=self.index['pts']
+            i=numpy.searchsorted(pts,pts[0]+int(seconds*1e9),'right')-1
+            frame=int(self.index['frame'][max(i,0)])
+        else:
+            frame=int(seconds*self.rate)
+        with self.lock:
+            self.position=min(max(frame,0),len(self.data))
+            self.restart=True
+            self.jumped=True
+        if not self.paused:
+            self.playing.set()
+
+    def set_speed(self,speed):
+        self.speed=speed
+        self.restart=True
+
+    def pause(self,paused=True):
+        self.paused=paused
+        if paused:
+            self.playing.clear()
+        else:
+            self.restart=True
+            self.playing.set()
+
+    def run(self):
+        while True:
+            self.playing.wait()
+            with self.lock:
+                if self.restart:
+                    start=time.perf_counter()
+                    origin=self.position
+                    self.restart=False
+                position=self.position
+                if position+self.frames > len(self.data):
+                    self.playing.clear()
+                    self.jumped=True
+                    continue
+                self.position=position+self.frames
+                jumped,self.jumped=self.jumped,False
+            samples=wavio.to_int16(self.data[position:position+self.frames],self.width)
+            self.worker.submit(numpy.asarray(samples).reshape(-1),block=True,restart=jumped)
+
+            speed=self.speed
+            if speed:
+                delay=start+(position+self.frames-origin)/float(self.rate)/speed-time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
@@ -31,12 +31,18 @@ gi.require_version("Gst","1.0")
 from gi.repository import GObject, Gtk, Gdk, Gst, GLib
 
 import time
+import argparse
 import struct
 import numpy
 from math import sqrt
 from numpy import conj
 from numpy.fft import fft, ifft
 
+from dsp import ringBuffer, get_plan, skip_stream
+from engine import bufferPool, dspWorker, frameAssembler, capture_stamp, deinterleave, continuityTracker, replaySource
+from metrics import stageMetrics
+from render import draw_envelope, levelMap, waterfall
+
 # Convert x location in plot to Hz
 def convert_to_hz(x,sample_rate,block_size):
     return x*sample_rate/block_size*2
@@ -57,32 +63,133 @@ class gtkSpec:
 
     def destroy_event(self, data=None):
         self.pipeline.set_state(Gst.State.NULL)
+        self.worker.stop()
         Gtk.main_quit()
 
     def buffer_cb(self, sink):
-        # Unpack and FFT data
-        sample=sink.emit('pull-sample')
-        buffer=sample.get_buffer()
-        self.data=numpy.frombuffer(buffer.extract_dup(0,buffer.get_size()),
-                                   dtype=numpy.int16)
+        with self.metrics.stage('capture'):
+            # Copy the samples out of the buffer into a pooled array
+            sample=sink.emit('pull-sample')
+            buffer=sample.get_buffer()
+            ok,info=buffer.map(Gst.MapFlags.READ)
+            if not ok:
+                return Gst.FlowReturn.OK
+            try:
+                samples=self.pool.fill(info.data)
+            finally:
+                buffer.unmap(info)
+            gap=self.continuity.check(buffer.pts,buffer.duration,buffer.offset,len(samples)//self.channels,
+                                      buffer.has_flags(Gst.BufferFlags.DISCONT))
+            clock=sink.get_clock()
+            running=clock.get_time()-sink.get_base_time() if clock is not None else None
+            stamp=capture_stamp(running,buffer.pts,buffer.duration)
+            self.assembler.submit(samples,gap=gap,stamp=stamp)
 
         return Gst.FlowReturn.OK
 
     def trigger_update(self):
+        if self.replay is not None:
+            self.seekbar.set_value(self.replay.time())
         rect=self.screen.get_allocation()
         self.window.get_window().invalidate_rect(rect,True)
         return True
         
-    def update_display(self,widget,ctx):
+    # Account for samples lost before the next buffer (runs on the DSP worker thread)
+    def gap_cb(self,frames):
+        if self.gapPolicy != 'ignore':
+            skip_stream(frames,self.samples,fill=self.gapPolicy == 'zero')
+
+    # Start over after a break in the stream, such as a replay seek (runs on
+    # the DSP worker thread)
+    def restart_cb(self):
+        skip_stream(0,self.samples,fill=False)
+
+    # Process one buffer of samples (runs on the DSP worker thread)
+    def process(self,samples):
+        self.metrics.tick('buffers')
         
-        self.dataBlock=numpy.concatenate((self.dataBlock[int(self.blockSize/2):],self.data))
-        data_fft=fft(self.dataBlock)
+        with self.metrics.stage('fft'):
+            # Every channel in one batch of transforms, one shown
+            self.samples.write(deinterleave(samples,self.channels))
+            self.dataBlock=self.samples.view()
+            data_fft=self.plan.forward(self.dataBlock)
+            if data_fft.ndim > 1:
+                data_fft=data_fft[self.channel]
+
+        with self.metrics.stage('render'):
+            mode=self.mode
+            data=None
+            newpt=None
+            if( mode == 2 ): # Autocorrelation
+                data=20*numpy.log10(0.01+abs(self.plan.inverse(data_fft*conj(data_fft))))
+                data[data<-20]=-20
+                data=data+20
+                data=data[0:self.screenWidth-1]
+                data=numpy.pad(data,(0,self.screenWidth-1-len(data)))
+
+            if( mode == 0 or mode == 1 or mode == 3): # Frequency domain preproc
+                data=20*numpy.log10(0.01+abs(data_fft))
+
+                # Adjust data for better plotting
+                data[data<-20]=-20
+                data=data+20
+
+                # A real transform only has bins up to the Nyquist frequency
+                data=data[0:self.screenWidth-1]
+                data=numpy.pad(data,(0,self.screenWidth-1-len(data)))
+
+            if( mode == 3 ):
+                self.spectrogram.push(data_fft)
+
+            if( mode == 1 ):
+                # Add a point to the track
+                # Peak within 5 bins of each marker, clamped to the spectrum
+                def peak(marker):
+                    lo=min(max(marker-5,0),len(data_fft)-1)
+                    return int(max(abs(data_fft[lo:marker+5])))
+                newpt=(peak(self.marker1),peak(self.marker2))
+                self.track.append(newpt)
+
+        return (mode,data,newpt)
+
+    # Draw the display, timing it and adding the metrics overlay if enabled
+    def draw_cb(self,widget,ctx):
+        with self.metrics.stage('draw'):
+            self.update_display(widget,ctx)
+        self.metrics.tick('frames')
+        latency=self.worker.displayed()
+        if latency is not None:
+            self.metrics.stage('latency').add(latency)
+
+        if self.metricscheck.get_active():
+            ctx.set_source_rgb(1,1,0)
+            ctx.set_font_size(11)
+            ctx.select_font_face('Monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+            for i,line in enumerate(self.metrics.lines()):
+                ctx.move_to(10,self.screenHeight-10-14*i)
+                ctx.show_text(line)
+        return True
+
+    def update_display(self,widget,ctx):
 
         # Erase current display
         ctx.set_source_rgb(0,0,0)
         ctx.rectangle(0,0,self.screenWidth,self.screenHeight)
         ctx.fill()
-        if( self.mode == 2 ):
+
+        self.status.set_text(self.worker.status()+'\n'+self.continuity.status()+'\n'+self.pool.status())
+
+        # Pick up the latest processed block
+        if self.worker.latest is None:
+            return True
+        mode,data,newpt=self.worker.latest
+
+        # Magnitude readouts
+        self.marker1_mag.set_text(str(data[int(self.marker1)])+' dB')
+        self.marker2_mag.set_text(str(data[int(self.marker2)])+' dB')
+        self.marker3_mag.set_text(str(data[int(self.marker3)])+' dB')
+
+        if( mode == 2 ):
             # Draw markers
             ctx.set_source_rgb(1,0,0)
             ctx.new_path()
@@ -105,49 +212,13 @@ class gtkSpec:
             # Draw autocorrelation
             ctx.set_source_rgb(1,1,1)
 
-            data=20*numpy.log10(0.01+abs(ifft(data_fft*conj(data_fft))))
-            data[data<-20]=-20
-            data=data+20
-            data=data[range(0,self.screenWidth-1)]
-
-            # Magnitude readouts
-            self.marker1_mag.set_text(str(data[int(self.marker1)])+' dB')
-            self.marker2_mag.set_text(str(data[int(self.marker2)])+' dB')
-            self.marker3_mag.set_text(str(data[int(self.marker3)])+' dB')
+            draw_envelope(ctx,data,data,self.screenHeight)
 
-            ctx.new_path()
-            ctx.move_to(0,int(self.screenHeight-data[0]))
-            for i,e in enumerate(data):
-                ctx.line_to(i,int(self.screenHeight-e))
-            
-            ctx.stroke()
-        if( self.mode == 0 or self.mode == 1 or self.mode == 3): # Frequency domain preproc
-            data=20*numpy.log10(0.01+abs(data_fft))
-
-            # Adjust data for better plotting
-            data[data<-20]=-20
-            data=data+20
-            data=data[range(0,self.screenWidth-1)]
-
-            # Magnitude readouts
-            self.marker1_mag.set_text(str(data[int(self.marker1)])+' dB')
-            self.marker2_mag.set_text(str(data[int(self.marker2)])+' dB')
-            self.marker3_mag.set_text(str(data[int(self.marker3)])+' dB')
-
-        if( self.mode == 3 ):
-            self.spectrogram[1:(self.screenHeight-1),:]=self.spectrogram[0:(self.screenHeight-2),:]
-            self.spectrogram[0,:]=data*2
-            dat = numpy.array(self.spectrogram, dtype=numpy.uint8)
-            dat.shape=(dat.shape[0],dat.shape[1],1)
-            dat = numpy.concatenate((dat,dat,dat,numpy.zeros_like(dat)),axis=2)
-            surface = cairo.ImageSurface.create_for_data(dat,cairo.FORMAT_ARGB32,dat.shape[1],dat.shape[0])
-            ctx.set_source_surface(surface,0,0)
-            ctx.paint()
+        if( mode == 3 ):
+            with self.worker.lock:
+                self.spectrogram.draw(ctx)
 
-        else:
-            self.spectrogram=numpy.zeros((self.screenHeight,self.screenWidth-1))
-
-        if( self.mode == 0 or self.mode == 3 ):
+        if( mode == 0 or mode == 3 ):
             # Draw markers
             
             ctx.set_source_rgb(1,0,0)
@@ -169,22 +240,13 @@ class gtkSpec:
             ctx.stroke()
 
 
-        if( self.mode == 0 ):
+        if( mode == 0 ):
             # Draw spectrum
             ctx.set_source_rgb(1,1,1)
-            ctx.new_path()
-            ctx.move_to(0,int(self.screenHeight-data[0]))
-            for i,e in enumerate(data):
-                ctx.line_to(i,int(self.screenHeight-e))
-            
-            ctx.stroke()
+            draw_envelope(ctx,data,data,self.screenHeight)
 
-        if( self.mode == 1 ):
+        if( mode == 1 and len(self.track) > 0 ):
             # Plot points on a track
-            marker1val=int(max(abs(data_fft[self.marker1-5:self.marker1+5])))
-            marker2val=int(max(abs(data_fft[self.marker2-5:self.marker2+5])))
-            newpt=(marker1val,marker2val)
-            self.track.append(newpt)
             scale=scale_track(self.track,self.screenWidth,self.screenHeight)
 
             ctx.set_source_rgb(1,1,1)
@@ -206,10 +268,12 @@ class gtkSpec:
         return True
 
     def swapmode(self,event):
-        self.mode=self.modeSelect.get_active()
+        with self.worker.lock:
+            self.mode=self.modeSelect.get_active()
+            self.spectrogram.clear()
+            if( self.mode == 2 or self.mode == 0 ):
+                self.track=[]
         self.repaint(self)
-        if( self.mode == 2 or self.mode == 0 ):
-            self.track=[]
         return True
 
     def button_cb(self,widget,event):
@@ -246,25 +310,64 @@ class gtkSpec:
 
             self.screen.set_size_request(self.screenWidth,self.screenHeight)
             if (data.width-self.width) !=0 or (data.height-self.height) != 0:
-                self.spectrogram=numpy.zeros((self.screenHeight,self.screenWidth-1))
+                with self.worker.lock:
+                    self.spectrogram=waterfall(self.screenWidth-1,self.screenHeight,self.levels)
                 
             self.width=data.width
             self.height=data.height
    
         return True
 
-    def __init__(self):
+    def __init__(self,replay=None,speed=1.0,gapPolicy='zero',
+                 captureBlock=None,hop=None,bufferTime=None,latencyTime=None,channels=1):
         self.window = Gtk.Window()
 
         # Transform parameters
         self.blockSize=2048
         self.blocks=1
+        self.channels=channels # Interleaved capture channels, transformed together
+        self.channel=0 # Channel on display
         self.sampleRate=44100
         self.screenWidth=512
         self.screenHeight=380
 
-        self.dataBlock=numpy.zeros(int(self.blocks*self.blockSize/2))
-        self.spectrogram=numpy.zeros((self.screenHeight,self.screenWidth-1))
+        self.samples=ringBuffer(int(self.blocks*self.blockSize/2),channels=channels if channels > 1 else None)
+        self.plan=get_plan(int(self.blocks*self.blockSize/2))
+        self.dataBlock=self.samples.view()
+        self.palette='grey' # See render.palettes
+
+        # Spectrogram levels: 40 dB per decade above a 0.01 magnitude floor,
+        # twice the spectrum trace scale
+        self.levels=levelMap(self.palette,scale=40.0,offset=40.0,floor=0.01)
+        self.spectrogram=waterfall(self.screenWidth-1,self.screenHeight,self.levels)
+
+        # Processing runs on its own thread, fed by buffer_cb
+        self.pool=bufferPool(int(self.blockSize/2)*self.channels)
+        self.worker=dspWorker(self.process,gap=self.gap_cb,pool=self.pool,channels=self.channels,
+                              restart=self.restart_cb)
+        self.continuity=continuityTracker(self.sampleRate)
+        self.gapPolicy=gapPolicy # What to do about lost samples: zero, resync or ignore
+
+        # Capture settings, independent of the transform size: pulsesrc
+        # delivers captureBlock bytes per channel at a time, which are cut
+        # into frames of blockSize bytes starting every hopSize bytes
+        self.captureBlock=int(captureBlock or self.blockSize)
+        self.hopSize=int(hop or self.blockSize)
+        self.bufferTime=bufferTime # pulsesrc buffer-time in microseconds, None for its default
+        self.latencyTime=latencyTime # pulsesrc latency-time in microseconds, None for its default
+        self.assembler=frameAssembler(self.worker,int(self.blockSize/2),int(self.hopSize/2),
+                                      self.sampleRate,self.pool,channels=self.channels)
+
+        # Stage timings, shown with the Metrics box and served by --metrics-port
+        self.metrics=stageMetrics()
+        self.metrics.watch(self.worker)
+
+        # Replay a recording in place of the sound card, if given one
+        self.replay=None
+        if replay is not None:
+            self.replay=replaySource(replay,self.assembler,int(self.captureBlock/2)*self.channels,speed,
+                                     0 if self.channels == 1 else None,self.sampleRate,
+                                     self.channels)
 
         # Window boilerplate
         self.window.set_title("Python Spectrum Analyzer")
@@ -280,7 +383,7 @@ class gtkSpec:
         self.screen.set_size_request(self.screenWidth,self.screenHeight)
         self.screen.connect("button_press_event",self.button_cb)
         self.screen.add_events( Gdk.EventMask.BUTTON_PRESS_MASK )
-        self.screen.connect("draw",self.update_display)
+        self.screen.connect("draw",self.draw_cb)
         
 
         self.marker1=100
@@ -294,11 +397,15 @@ class gtkSpec:
         self.pipeline=Gst.Pipeline.new("mypipeline")
 
         src=Gst.ElementFactory.make("pulsesrc", "src")
-        src.set_property("blocksize",self.blockSize)
+        src.set_property("blocksize",self.captureBlock*self.channels)
+        if self.bufferTime:
+            src.set_property("buffer-time",self.bufferTime)
+        if self.latencyTime:
+            src.set_property("latency-time",self.latencyTime)
         self.pipeline.add(src)
 
         ac=Gst.ElementFactory.make("capsfilter","ac")
-        ac.set_property("caps",Gst.caps_from_string("audio/x-raw,format=S16LE,rate="+ str(self.sampleRate) + ",channels=1"))
+        ac.set_property("caps",Gst.caps_from_string("audio/x-raw,format=S16LE,rate="+ str(self.sampleRate) + ",channels=" + str(self.channels)))
         self.pipeline.add(ac)
 
         sink=Gst.ElementFactory.make("appsink","as")
@@ -358,21 +465,81 @@ class gtkSpec:
         self.modeSelect.connect('changed',self.swapmode)
         vbox.pack_end(self.modeSelect,True,True,0)
 
+        self.status=Gtk.Label(label='')
+        vbox.pack_end(self.status,True,True,0)
+        self.metricscheck=Gtk.CheckButton(label='Metrics')
+        self.metricscheck.set_active(False)
+        vbox.pack_end(self.metricscheck,True,True,0)
+
+        # Channel shown from a multi-channel capture
+        if self.channels > 1:
+            self.channelcombo=Gtk.ComboBoxText()
+            for i in range(0,self.channels):
+                self.channelcombo.append_text('Channel %d' % (i+1))
+            self.channelcombo.set_active(0)
+            self.channelcombo.connect('changed',self.channel_cb)
+            vbox.pack_end(self.channelcombo,True,True,0)
+
+        # Replay position and pause
+        if self.replay is not None:
+            hbox2=Gtk.HBox(homogeneous=False,spacing=0)
+            self.seekbar=Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL,0,max(self.replay.duration(),0.1),0.1)
+            self.seekbar.connect('change-value',self.seek_cb)
+            hbox2.pack_start(self.seekbar,True,True,0)
+            button=Gtk.ToggleButton(label='Pause')
+            button.connect('toggled',self.pause_cb)
+            hbox2.pack_start(button,False,False,0)
+            vbox.pack_end(hbox2,True,True,0)
+
         self.window.add(hbox)
         self.window.show_all()
 
-        if self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+        self.worker.start()
+        if self.replay is not None:
+            self.replay.start()
+        elif self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
             print('Error! Did not start pipeline')
 
-        self.data=numpy.zeros(self.dataBlock.shape)
         GLib.timeout_add(50,self.trigger_update)
         return
 
+    def channel_cb(self,widget):
+        self.channel=self.channelcombo.get_active()
+        return True
+
+    # Replay controls
+    def seek_cb(self,widget,scroll,value):
+        self.replay.seek(value)
+        return False
+
+    def pause_cb(self,widget):
+        self.replay.pause(widget.get_active())
+        return True
+
     def main(self):
         Gtk.main()
         return 0
 
 if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description='Spectrum analyzer')
+    parser.add_argument('--replay',metavar='WAV',help='process a recording instead of the sound card')
+    parser.add_argument('--speed',type=float,default=1.0,help='replay speed as a multiple of real time, 0 for as fast as possible')
+    parser.add_argument('--on-gap',choices=['zero','resync','ignore'],default='zero',
+                        help='treat lost samples as silence, restart the history, or ignore them')
+    parser.add_argument('--capture-block',type=int,help='bytes per channel in each capture buffer (default: the transform size)')
+    parser.add_argument('--hop',type=int,help='bytes between the starts of successive frames (default: the transform size)')
+    parser.add_argument('--buffer-time',type=int,help='pulsesrc buffer time in microseconds')
+    parser.add_argument('--latency-time',type=int,help='pulsesrc latency time in microseconds')
+    parser.add_argument('--channels',type=int,default=1,help='capture channels, transformed together')
+    parser.add_argument('--metrics-port',type=int,help='serve stage metrics as JSON on this local port')
+    parser.add_argument('--metrics-csv',metavar='FILE',help='log stage metrics to a CSV file every second')
+    args=parser.parse_args()
+
     Gst.init(None)
-    gtkspec=gtkSpec()
+    gtkspec=gtkSpec(args.replay,args.speed,args.on_gap,
+                   args.capture_block,args.hop,args.buffer_time,args.latency_time,args.channels)
+    if args.metrics_port:
+        gtkspec.metrics.serve(args.metrics_port)
+    if args.metrics_csv:
+        gtkspec.metrics.log(args.metrics_csv)
     gtkspec.main()
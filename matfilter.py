@@ -33,19 +33,19 @@ gi.require_version("Gst","1.0")
 from gi.repository import GObject, Gtk, Gdk, Gst, GLib
 
 import time
-import struct
-import wave
+import argparse
 import numpy
 from math import sqrt
 from numpy import conj
 from numpy.fft import fft, ifft
+from time import strftime
 
-# Unpack data 
-def unpack(str,bytesPerSample=2):
-    result=list()
-    for i in range(0,len(str)-1,bytesPerSample):
-        result.append(struct.unpack('h',str[i:i+bytesPerSample])[0])
-    return result
+from dsp import filterBank
+from engine import bufferPool, dspWorker, frameAssembler, capture_stamp, continuityTracker, replaySource
+from metrics import stageMetrics
+from render import column_envelope, draw_envelope
+from session import snrStore
+from wavio import load_reference
 
 # Convert x location in plot to Hz
 def convert_to_hz(x,sample_rate,block_size):
@@ -67,65 +67,121 @@ class matFilter:
 
     def destroy_event(self, data=None):
         self.pipeline.set_state(Gst.State.NULL)
+        self.worker.stop()
+        if self.session is not None:
+            self.session.close()
         Gtk.main_quit()
 
     def buffer_cb(self, sink):
-        # Unpack and FFT data
-        sample=sink.emit('pull-sample')
-        buffer=sample.get_buffer()
-        self.data=numpy.frombuffer(buffer.extract_dup(0,buffer.get_size()),
-                                   dtype=numpy.int16)
+        with self.metrics.stage('capture'):
+            # Copy the samples out of the buffer into a pooled array
+            sample=sink.emit('pull-sample')
+            buffer=sample.get_buffer()
+            ok,info=buffer.map(Gst.MapFlags.READ)
+            if not ok:
+                return Gst.FlowReturn.OK
+            try:
+                samples=self.pool.fill(info.data)
+            finally:
+                buffer.unmap(info)
+            gap=self.continuity.check(buffer.pts,buffer.duration,buffer.offset,len(samples),
+                                      buffer.has_flags(Gst.BufferFlags.DISCONT))
+            clock=sink.get_clock()
+            running=clock.get_time()-sink.get_base_time() if clock is not None else None
+            stamp=capture_stamp(running,buffer.pts,buffer.duration)
+            self.assembler.submit(samples,gap=gap,stamp=stamp)
 
         return Gst.FlowReturn.OK
 
     def trigger_update(self):
+        if self.replay is not None:
+            self.seekbar.set_value(self.replay.time())
         rect=self.screen.get_allocation()
         self.window.get_window().invalidate_rect(rect,True)
         return True
         
-    def update_display(self,widget,ctx):
+    # Account for samples lost before the next buffer (runs on the DSP worker thread)
+    def gap_cb(self,frames):
+        if self.gapPolicy != 'ignore':
+            self.chain.skip(frames,self.gapPolicy == 'zero')
+
+    # Start over after a break in the stream, such as a replay seek (runs on
+    # the DSP worker thread)
+    def restart_cb(self):
+        self.chain.skip(0,False)
+
+    # Process one buffer of samples (runs on the DSP worker thread)
+    def process(self,samples):
+        self.metrics.tick('buffers')
+        snrs,maxnum,traces=self.chain.process(samples)
+
+        # Log every reading while a session log is open
+        session=self.session
+        if session is not None:
+            session.append(snrs/10.0,maxnum)
+
+        # Traces for the first four filters
+        plots=[]
+        with self.metrics.stage('render'):
+            for trace in traces:
+                data=20*numpy.log10(0.01+abs(trace))
+                data[data<-20]=-20
+                data=data+20
 
-        # Update the data area
-        self.dataBlock=numpy.concatenate((self.dataBlock[int(self.blockSize/2):],self.data))
-        data_fft=fft(self.dataBlock)        
+                # Fit the whole block across the display, keeping narrow peaks
+                plots.append(column_envelope(data,512))
+
+        return (snrs,plots,maxnum)
+
+    # Draw the display, timing it and adding the metrics overlay if enabled
+    def draw_cb(self,widget,ctx):
+        with self.metrics.stage('draw'):
+            self.update_display(widget,ctx)
+        self.metrics.tick('frames')
+        latency=self.worker.displayed()
+        if latency is not None:
+            self.metrics.stage('latency').add(latency)
+
+        if self.metricscheck.get_active():
+            ctx.set_source_rgb(1,1,0)
+            ctx.set_font_size(11)
+            ctx.select_font_face('Monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+            for i,line in enumerate(self.metrics.lines()):
+                ctx.move_to(10,380-10-14*i)
+                ctx.show_text(line)
+        return True
+
+    def update_display(self,widget,ctx):
 
         # Erase current display
         ctx.set_source_rgb(0,0,0)
         ctx.rectangle(0,0,512,380)
         ctx.fill()
 
-        # Manage storing of data if storage is queued
-        if self.storing:
-            newData=numpy.zeros((1,self.filters))
+        status=self.worker.status()+'\n'+self.continuity.status()+'\n'+self.pool.status()
+        session=self.session
+        if session is not None:
+            status+='\n'+session.status()
+        self.status.set_text(status)
+
+        # Pick up the latest processed block
+        if self.worker.latest is None:
+            return True
+        snrs,plots,maxnum=self.worker.latest
 
         # Plot each filter position
-        maxSNR=0
-        maxnum=-1
         for i in range(0,self.filters):
-            # Compute filter coefficients
-            corr=ifft(data_fft*self.ref[i])
-
-            # Compute filter SNR
+            snr=snrs[i]
             if self.sinrcheck.get_active():
-                snr=100*numpy.log10(max(abs(corr)+0.01)/(numpy.std(abs(corr))+numpy.mean(abs(corr)+0.01)))
                 ym=int(370-snr)
             else:
-                snr=100*numpy.log10(max(abs(corr)+0.01))
                 ym=int(370-snr/10.0)
                 
             # Compute marker location
             xm=int((i+1)*(512/(self.filters+1)))
 
-            if self.storing:
-                newData[0,i]=snr/10.0
-
-            # Detect maximum filter readout
-            if snr > maxSNR:
-                maxSNR=snr
-                maxnum=i
-
             # Plot
-            if( i>=0 and i <=3 ):
+            if( i>=0 and i <=3 and i < len(plots) ):
                 if i==0:
                     ctx.set_source_rgb(1,1,1)
                 elif i==1:
@@ -135,27 +191,8 @@ class matFilter:
                 elif i==3:
                     ctx.set_source_rgb(0,0,1)
 
-                if self.centercheck.get_active():
-                    idx=numpy.argmax(abs(corr))
-                else:
-                    idx=0
-
-                if self.averagecheck.get_active():
-                    self.corr_data[i][0:numpy.size(self.corr_data[i],0)-idx]+=corr[idx:]
-                else:
-                    self.corr_data[i]=corr[idx:]
-
-                plotdat=self.corr_data[i][::int(self.blockSize/2*self.blocks/512)]
-
-                data=20*numpy.log10(0.01+abs(self.corr_data[i]))
-                data[data<-20]=-20
-                data=data+20
-
-                ctx.new_path()
-                ctx.move_to(0,int(380-data[0]))
-                for i2,e in enumerate(data):
-                    ctx.line_to(i2,int(380-e))
-                ctx.stroke()
+                lo,hi=plots[i]
+                draw_envelope(ctx,lo,hi,380)
 
             ctx.set_source_rgb(1,1,1)
             ctx.new_path()
@@ -188,25 +225,25 @@ class matFilter:
             ctx.line_to(y,380)
             ctx.stroke()
 
-        # Finalize stored data
+        # Store the readings if requested
         if self.storing:
-            self.savedData=numpy.append(self.savedData,newData,0)
-            self.storeButton.set_label('Store #' + str(numpy.size(self.savedData,0)+1))
+            self.savedData.append(snrs/10.0,maxnum)
+            self.storeButton.set_label('Store #' + str(len(self.savedData)+1))
             self.storing=False
             
         return True
 
     def entry_update(self,event,data): # data contains the index of the entry box that changed
-        # Open reference WAV file
+        # Open reference WAV file and unpack it into a numpy array
         try:
-            f=wave.open(self.entry[data].get_text(),'r')
+            wavdata=load_reference(self.entry[data].get_text())
         except:
             print(self.entry[data].get_text())
             return True # Ignore file errors
 
-        # Unpack file into a numpy array
-        wavdata=unpack(f.readframes(f.getnframes()),f.getsampwidth())
-        self.ref[data]=numpy.conjugate(fft(wavdata,int(self.blockSize/2*self.blocks)))
+        with self.worker.lock:
+            self.chain.set_reference(data,wavdata)
+        self.savedData.names[data]=self.entry[data].get_text()
 
         return True
 
@@ -215,8 +252,8 @@ class matFilter:
         return True
 
     def delete_cb(self,event): # Delete a datapoint
-        self.savedData=self.savedData[0:-1,:]
-        self.storeButton.set_label('Store #' + str(1+numpy.size(self.savedData,0)))
+        self.savedData.delete_last()
+        self.storeButton.set_label('Store #' + str(1+len(self.savedData)))
         return True
 
     def save_cb(self,event): # Save the data to file
@@ -229,46 +266,107 @@ class matFilter:
         
         response=dialog.run()
         if response==Gtk.ResponseType.OK:
-            # Save the data
-            numpy.savetxt(dialog.get_filename(),self.savedData,fmt='%2.4f')
+            # Save the data in the background
+            self.savedData.export_csv(dialog.get_filename())
             
             # Clear old data
             self.storing=False
-            self.savedData=numpy.zeros((0,self.filters))
+            self.savedData=snrStore(self.filter_names())
             self.storeButton.set_label('Store #1')
 
         dialog.destroy()
 
         return True
 
+    # Start or stop logging every reading to a binary session log
+    #  The log header names the filters, so they can't be renamed while it
+    #  is open.
+    def log_cb(self,event):
+        if self.logButton.get_active():
+            session=snrStore(self.filter_names())
+            session.stream(strftime("%Y%m%d%H%M%S.snr"))
+            self.session=session
+        elif self.session is not None:
+            session=self.session
+            self.session=None
+            session.close()
+        for entry in self.entry:
+            entry.set_sensitive(self.session is None)
+        return True
+
+    # Names for the filters in stored and logged readings
+    def filter_names(self):
+        names=[]
+        for i in range(0,self.filters):
+            if i < len(self.entry):
+                name=self.entry[i].get_text()
+            elif i < len(self.references):
+                name=self.references[i]
+            else:
+                name=''
+            names.append(name or 'filter ' + str(i+1))
+        return names
+
     def capture_cb(self,event,data):
         # Capture the current samples as a reference
-        self.ref[data]=numpy.conjugate(fft(self.dataBlock))
+        with self.worker.lock:
+            self.chain.capture(data)
+        return True
+
+    # Copy the check boxes into plain attributes the DSP worker can read
+    def controls_cb(self,event):
+        self.chain.averaging=self.averagecheck.get_active()
+        self.chain.centering=self.centercheck.get_active()
+        self.chain.sinr=self.sinrcheck.get_active()
         return True
 
     def average_cb(self,event):
-        self.corr_data=[]
-        for i in range(0,self.filters):
-            self.corr_data.append(numpy.zeros(int(self.blockSize/2*self.blocks),dtype='complex128'))
+        with self.worker.lock:
+            self.chain.reset()
         return True
 
-    def __init__(self):
+    def __init__(self,filters=8,workers=1,references=[],replay=None,speed=1.0,gapPolicy='zero',
+                 captureBlock=None,hop=None,bufferTime=None,latencyTime=None):
         self.window = Gtk.Window()
 
         # Transform parameters
         self.blockSize=32768
         self.blocks=1
         self.sampleRate=44100
-        self.dataBlock=numpy.zeros(int(self.blocks*self.blockSize/2))
-        self.filters=8
-        self.corr_data=[]
-        for i in range(0,self.filters):
-            self.corr_data.append(numpy.zeros(int(self.blockSize/2*self.blocks)))
-
-        # Default reference signals
-        self.ref=[]
-        for i in range(0,self.filters):
-            self.ref.append(numpy.zeros(int(self.blockSize/2*self.blocks)))
+        self.filters=max(filters,len(references))
+        self.references=references
+
+        # Filter bank, starting with empty reference signals unless given a library
+        self.chain=filterBank(self.filters,self.blockSize,self.blocks,workers=workers)
+        for i,filename in enumerate(references):
+            self.chain.set_reference(i,load_reference(filename))
+
+        # Processing runs on its own thread, fed by buffer_cb
+        self.pool=bufferPool(int(self.blockSize/2))
+        self.worker=dspWorker(self.process,gap=self.gap_cb,pool=self.pool,restart=self.restart_cb)
+        self.continuity=continuityTracker(self.sampleRate)
+        self.gapPolicy=gapPolicy # What to do about lost samples: zero, resync or ignore
+
+        # Capture settings, independent of the transform size: pulsesrc
+        # delivers captureBlock bytes at a time, which are cut into frames of
+        # blockSize bytes starting every hopSize bytes
+        self.captureBlock=int(captureBlock or self.blockSize)
+        self.hopSize=int(hop or self.blockSize)
+        self.bufferTime=bufferTime # pulsesrc buffer-time in microseconds, None for its default
+        self.latencyTime=latencyTime # pulsesrc latency-time in microseconds, None for its default
+        self.assembler=frameAssembler(self.worker,int(self.blockSize/2),int(self.hopSize/2),
+                                      self.sampleRate,self.pool)
+
+        # Stage timings, shown with the Metrics box and served by --metrics-port
+        self.metrics=stageMetrics()
+        self.metrics.watch(self.worker)
+        self.chain.metrics=self.metrics
+        self.session=None # snrStore streaming every reading while logging
+
+        # Replay a recording in place of the sound card, if given one
+        self.replay=None
+        if replay is not None:
+            self.replay=replaySource(replay,self.assembler,int(self.captureBlock/2),speed,rate=self.sampleRate)
 
         # Window boilerplate
         self.window.set_title("Matched filter bank")
@@ -278,14 +376,18 @@ class matFilter:
 
         # Display area boilerplate
         self.screen=Gtk.DrawingArea()
-        self.screen.connect("draw",self.update_display)
+        self.screen.connect("draw",self.draw_cb)
 
         # Construct gstreamer pipeline to funnel data into the application
         # pulsesrc ! capsfilter ! appsink ! (this program)
         self.pipeline=Gst.Pipeline.new("mypipeline")
 
         src=Gst.ElementFactory.make("pulsesrc", "src")
-        src.set_property("blocksize",self.blockSize)
+        src.set_property("blocksize",self.captureBlock)
+        if self.bufferTime:
+            src.set_property("buffer-time",self.bufferTime)
+        if self.latencyTime:
+            src.set_property("latency-time",self.latencyTime)
         self.pipeline.add(src)
 
         ac=Gst.ElementFactory.make("capsfilter","ac")
@@ -312,15 +414,35 @@ class matFilter:
         hbox2=Gtk.HBox(homogeneous=True,spacing=0)
         self.averagecheck=Gtk.CheckButton(label='Averaging');
         self.averagecheck.connect('toggled',self.average_cb)
+        self.averagecheck.connect('toggled',self.controls_cb)
         hbox2.pack_start(self.averagecheck,True,True,0)
         self.centercheck=Gtk.CheckButton(label='Center');
+        self.centercheck.connect('toggled',self.controls_cb)
         hbox2.pack_start(self.centercheck,True,True,0)
         self.sinrcheck=Gtk.CheckButton(label='SINR');
+        self.sinrcheck.connect('toggled',self.controls_cb)
         hbox2.pack_start(self.sinrcheck,True,True,0)
         vbox.pack_start(hbox2,True,True,0)
+        self.controls_cb(None)
         
         self.detectedText=Gtk.Label(label='Detected filter: None')
         vbox.pack_start(self.detectedText,True,True,0)
+        self.status=Gtk.Label(label='')
+        vbox.pack_start(self.status,True,True,0)
+        self.metricscheck=Gtk.CheckButton(label='Metrics')
+        self.metricscheck.set_active(False)
+        vbox.pack_start(self.metricscheck,True,True,0)
+
+        # Replay position and pause
+        if self.replay is not None:
+            hbox2=Gtk.HBox(homogeneous=False,spacing=0)
+            self.seekbar=Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL,0,max(self.replay.duration(),0.1),0.1)
+            self.seekbar.connect('change-value',self.seek_cb)
+            hbox2.pack_start(self.seekbar,True,True,0)
+            button=Gtk.ToggleButton(label='Pause')
+            button.connect('toggled',self.pause_cb)
+            hbox2.pack_start(button,False,False,0)
+            vbox.pack_start(hbox2,True,True,0)
 
         # Datafile controls
         hbox2=Gtk.HBox(homogeneous=True,spacing=0)
@@ -333,41 +455,78 @@ class matFilter:
         saveButton=Gtk.Button(label='Save')
         saveButton.connect('clicked',self.save_cb)
         hbox2.pack_start(saveButton,True,True,0)
+        self.logButton=Gtk.ToggleButton(label='Log')
+        self.logButton.connect('toggled',self.log_cb)
+        hbox2.pack_start(self.logButton,True,True,0)
         vbox.pack_start(hbox2,True,True,0)
         self.storing=False
-        self.savedData=numpy.zeros((0,self.filters))
 
-        # Matched filter reference files
+        # Matched filter reference files (only the first few are editable)
         self.entry=[]
-        for i in range(0,self.filters):
+        for i in range(0,min(self.filters,8)):
             hbox2=Gtk.HBox(homogeneous=True,spacing=0)
             capture=Gtk.Button(label='Capture ' + str(i+1))
             capture.connect('clicked',self.capture_cb,i)
             hbox2.pack_start(capture,True,True,0)
 
             self.entry.append(Gtk.Entry())
+            if i < len(references):
+                self.entry[i].set_text(references[i])
             self.entry[i].connect('activate',self.entry_update,i)
             hbox2.pack_start(self.entry[i],True,True,0)
 
             vbox.pack_start(hbox2,True,True,0)
+        self.savedData=snrStore(self.filter_names())
 
         # Assemble the window
         self.window.add(hbox)
         self.window.show_all()
 
-        if self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+        self.worker.start()
+        if self.replay is not None:
+            self.replay.start()
+        elif self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
             print('Error! Did not start pipeline')
 
-        self.data=numpy.zeros(self.dataBlock.shape)
         GLib.timeout_add(50,self.trigger_update)
         
         return
 
+    # Replay controls
+    def seek_cb(self,widget,scroll,value):
+        self.replay.seek(value)
+        return False
+
+    def pause_cb(self,widget):
+        self.replay.pause(widget.get_active())
+        return True
+
     def main(self):
         Gtk.main()
         return 0
 
 if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description='Interactive matched filter bank')
+    parser.add_argument('--filters',type=int,default=8,help='number of filters in the bank')
+    parser.add_argument('--workers',type=int,default=1,help='threads evaluating the bank')
+    parser.add_argument('references',nargs='*',help='reference WAV files to load into the bank')
+    parser.add_argument('--replay',metavar='WAV',help='process a recording instead of the sound card')
+    parser.add_argument('--speed',type=float,default=1.0,help='replay speed as a multiple of real time, 0 for as fast as possible')
+    parser.add_argument('--on-gap',choices=['zero','resync','ignore'],default='zero',
+                        help='treat lost samples as silence, restart the history, or ignore them')
+    parser.add_argument('--capture-block',type=int,help='bytes per capture buffer (default: the transform size)')
+    parser.add_argument('--hop',type=int,help='bytes between the starts of successive frames (default: the transform size)')
+    parser.add_argument('--buffer-time',type=int,help='pulsesrc buffer time in microseconds')
+    parser.add_argument('--latency-time',type=int,help='pulsesrc latency time in microseconds')
+    parser.add_argument('--metrics-port',type=int,help='serve stage metrics as JSON on this local port')
+    parser.add_argument('--metrics-csv',metavar='FILE',help='log stage metrics to a CSV file every second')
+    args=parser.parse_args()
+
     Gst.init()
-    matfilter=matFilter()
+    matfilter=matFilter(args.filters,args.workers,args.references,args.replay,args.speed,args.on_gap,
+                       args.capture_block,args.hop,args.buffer_time,args.latency_time)
+    if args.metrics_port:
+        matfilter.metrics.serve(args.metrics_port)
+    if args.metrics_csv:
+        matfilter.metrics.log(args.metrics_csv)
     matfilter.main()
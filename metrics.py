@@ -0,0 +1,185 @@
+#
+# Live timing and throughput metrics for the processing and display stages
+#  Stages are timed into small rings of recent durations for rolling
+#  percentiles, and events such as buffers and frames into rings of times for
+#  rates.  Summaries can be drawn on screen, logged to CSV or served as JSON.
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import csv
+import json
+import time
+import threading
+import http.server
+import numpy
+
+# Times a stage into a ring of its most recent durations
+class stageTimer:
+    def __init__(self,history):
+        self.durations=numpy.zeros(history)
+        self.count=0
+
+    def __enter__(self):
+        self.start=time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.add(time.perf_counter()-self.start)
+        return False
+
+    def add(self,seconds):
+        self.durations[self.count % len(self.durations)]=seconds
+        self.count+=1
+
+    # Recorded durations, in no particular order
+    def recent(self):
+        return self.durations[:min(self.count,len(self.durations))]
+
+# Stand-in for a stageTimer when metrics are off
+class nullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        return False
+
+    def add(self,seconds):
+        pass
+
+# Metrics for one tool
+#  stage(name) returns the timer for a stage, to be used as a context
+#  manager; tick(name) counts an event.  Workers added with watch report
+#  their queue and drop counters in the summary.
+class stageMetrics:
+    def __init__(self,history=256):
+        self.history=history
+        self.timers={}
+        self.events={}
+        self.workers=[]
+
+    def stage(self,name):
+        timer=self.timers.get(name)
+        if timer is None:
+            timer=self.timers[name]=stageTimer(self.history)
+        return timer
+
+    def tick(self,name):
+        self.stage('@'+name).add(time.perf_counter())
+
+    def watch(self,worker):
+        self.workers.append(worker)
+
+    # Events per second over the recorded ticks
+    def rate(self,name):
+        timer=self.timers.get('@'+name)
+        if timer is None or timer.count < 2:
+            return 0.0
+        times=timer.recent()
+        span=time.perf_counter()-times.min()
+        return (len(times)-1)/span if span > 0 else 0.0
+
+    # Nested dict of percentiles in milliseconds, rates and worker counters
+    def summary(self):
+        result={'stages':{},'rates':{},'workers':{}}
+        for name,timer in list(self.timers.items()):
+            if name.startswith('@'):
+                result['rates'][name[1:]]=self.rate(name[1:])
+            elif timer.count:
+                ms=1000*timer.recent()
+                p50,p90,p99=numpy.percentile(ms,[50,90,99])
+                result['stages'][name]={'p50':p50,'p90':p90,'p99':p99,'max':ms.max(),'count':timer.count}
+        for worker in self.workers:
+            result['workers'][worker.name]={'queued':worker.queue.qsize(),'maxQueued':worker.maxQueued,
+                                            'processed':worker.processed,'dropped':worker.dropped,
+                                            'errors':worker.errors}
+        return result
+
+    # Summary as lines of text for an on-screen overlay
+    def lines(self):
+        summary=self.summary()
+        lines=[]
+        if summary['rates']:
+            lines.append('  '.join('%s %0.1f/s' % item for item in sorted(summary['rates'].items())))
+        for name,worker in summary['workers'].items():
+            lines.append('%s: queued %d (max %d) dropped %d' % (name,worker['queued'],
+                                                               worker['maxQueued'],worker['dropped']))
+        for name,stats in sorted(summary['stages'].items()):
+            lines.append('%-10s p50 %6.2f  p90 %6.2f  p99 %6.2f ms' % (name,stats['p50'],stats['p90'],stats['p99']))
+        return lines
+
+    # Append the summary to a CSV file every interval seconds
+    #  One row per value: time, metric, value, with metric names such as
+    #  correlate.p90 or rate.frames.
+    def log(self,filename,interval=1.0):
+        def run():
+            with open(filename,'w',newline='') as f:
+                writer=csv.writer(f)
+                writer.writerow(['time','metric','value'])
+                while True:
+                    time.sleep(interval)
+                    now='%0.3f' % time.time()
+                    for metric,value in flatten(self.summary()):
+                        writer.writerow([now,metric,'%0.6g' % value])
+                    f.flush()
+        threading.Thread(target=run,name='metrics-log',daemon=True).start()
+
+    # Serve the summary as JSON on http://127.0.0.1:port/
+    def serve(self,port):
+        metrics=self
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body=json.dumps(metrics.summary()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type','application/json')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args):
+                pass
+        server=http.server.ThreadingHTTPServer(('127.0.0.1',port),handler)
+        threading.Thread(target=server.serve_forever,name='metrics-http',daemon=True).start()
+        return server
+
+# Metrics that record nothing, the default for processing chains
+class nullMetrics:
+    timer=nullTimer()
+
+    def stage(self,name):
+        return self.timer
+
+    def tick(self,name):
+        pass
+
+disabled=nullMetrics()
+
+# (name,value) pairs for a summary, with dotted names
+def flatten(summary):
+    for name,value in summary['rates'].items():
+        yield 'rate.'+name,value
+    for name,worker in summary['workers'].items():
+        for key,value in worker.items():
+            yield name+'.'+key,value
+    for name,stats in summary['stages'].items():
+        for key,value in stats.items():
+            yield name+'.'+key,value
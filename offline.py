@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Headless batch processing of WAV recordings
+#  Runs the sounder, rdsounder and matfilter processing chains over recorded
+#  audio as fast as possible and writes the results to disk
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import sys
+import time
+import argparse
+import numpy
+import scipy.io
+
+import dsp
+from dsp import rangeProfile, rangeDoppler, filterBank
+from wavio import read_wav, load_reference
+
+# Split a recording into the buffers pulsesrc would have delivered
+#  blockSize is in bytes of S16LE audio, as for the live tools
+def recording_buffers(filename,blockSize,channel=0):
+    data,rate=read_wav(filename)
+    if data.ndim > 1:
+        data=data[:,channel]
+    length=int(blockSize/2)
+    count=len(data)//length
+    return data[:count*length].reshape(count,length),rate
+
+# Range profile per buffer, as sounder displays it
+def run_sounder(args,buffers):
+    chain=rangeProfile(load_reference(args.reference),args.block_size,1,args.window)
+    chain.matched=not args.no_matched
+    chain.centering=not args.no_center
+    chain.averaging=not args.no_average
+
+    profiles=numpy.zeros((len(buffers),chain.length))
+    for i,samples in enumerate(buffers):
+        profiles[i,:]=abs(chain.process(samples))
+
+    return {'profiles':profiles,
+            'averagingWindow':args.window}
+
+# Range-Doppler map every --every pulses, as rdsounder displays it
+def run_rdsounder(args,buffers):
+    chain=rangeDoppler(load_reference(args.reference),args.block_size,1,args.window)
+    chain.matched=not args.no_matched
+    chain.centering=not args.no_center
+    chain.doppler=not args.no_doppler
+    every=args.every or args.window
+
+    maps=[]
+    for i,samples in enumerate(buffers):
+        chain.process(samples)
+        if (i+1) % every == 0:
+            maps.append(abs(chain.image(span=args.span)))
+
+    return {'maps':numpy.array(maps).reshape(len(maps),args.window,chain.length),
+            'averagingWindow':args.window,
+            'every':every,
+            'dopplerSpan':args.span}
+
+# Filter bank SNR per buffer, in the units matfilter stores
+def run_matfilter(args,buffers):
+    chain=filterBank(len(args.reference),args.block_size,workers=args.workers)
+    for i,filename in enumerate(args.reference):
+        chain.set_reference(i,load_reference(filename))
+    chain.sinr=args.sinr
+
+    snr=numpy.zeros((len(buffers),chain.filters))
+    for i,samples in enumerate(buffers):
+        snrs,maxnum,traces=chain.process(samples)
+        snr[i,:]=snrs/10.0
+
+    return {'snr':snr}
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='Process WAV recordings without a sound card or display')
+    tools=parser.add_subparsers(dest='tool',required=True)
+
+    tool=tools.add_parser('sounder',help='averaged range profiles (.mat)')
+    tool.set_defaults(run=run_sounder,block_size=3000,window=10)
+    tool.add_argument('--no-average',action='store_true',help='disable pulse averaging')
+
+    tool=tools.add_parser('rdsounder',help='range-Doppler maps (.mat)')
+    tool.set_defaults(run=run_rdsounder,block_size=3000,window=100)
+    tool.add_argument('--no-doppler',action='store_true',help='store range-time history instead of Doppler')
+    tool.add_argument('--every',type=int,help='pulses between maps (default: the window length)')
+    tool.add_argument('--span',type=float,default=1.0,help='fraction of the unambiguous Doppler range to map')
+
+    for name in ['sounder','rdsounder']:
+        tool=tools.choices[name]
+        tool.add_argument('--reference',default='squeak.wav',help='transmit pulse WAV file')
+        tool.add_argument('--window',type=int,help='averaging window in pulses')
+        tool.add_argument('--no-matched',action='store_true',help='disable matched filtering')
+        tool.add_argument('--no-center',action='store_true',help='disable pulse centering')
+
+    tool=tools.add_parser('matfilter',help='filter bank SNR table (text)')
+    tool.set_defaults(run=run_matfilter,block_size=32768)
+    tool.add_argument('--reference',action='append',required=True,help='reference WAV file (repeat for each filter)')
+    tool.add_argument('--sinr',action='store_true',help='report SINR instead of peak level')
+    tool.add_argument('--workers',type=int,default=1,help='threads evaluating the bank')
+
+    for tool in tools.choices.values():
+        tool.add_argument('--block-size',type=int,help='capture block size in bytes')
+        tool.add_argument('--channel',type=int,default=0,help='channel of multi-channel recordings')
+        tool.add_argument('--complex-fft',action='store_true',help='use full complex transforms instead of real ones')
+        tool.add_argument('-o','--output',required=True,help='output file')
+        tool.add_argument('input',nargs='+',help='WAV recordings, processed in order')
+
+    args=parser.parse_args(argv)
+    dsp.realTransforms=not args.complex_fft
+
+    # Run all recordings through one chain so averaging carries across files
+    buffers=[]
+    for filename in args.input:
+        data,rate=recording_buffers(filename,args.block_size,args.channel)
+        buffers.append(data)
+    buffers=numpy.concatenate(buffers)
+
+    start=time.perf_counter()
+    result=args.run(args,buffers)
+    elapsed=time.perf_counter()-start
+
+    if args.tool == 'matfilter':
+        numpy.savetxt(args.output,result['snr'],fmt='%2.4f')
+    else:
+        result.update({'blockSize':args.block_size,
+                       'sampleRate':rate,
+                       'blocks':1})
+        scipy.io.savemat(args.output,result)
+
+    duration=buffers.size/float(rate)
+    print('%s: %d buffers, %0.1f s of audio in %0.2f s (%0.0fx real time)' %
+          (args.tool,len(buffers),duration,elapsed,duration/max(elapsed,1e-9)),file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+#
+# Display helpers shared by the sonar tools
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import numpy
+
+# Reduce a trace to the minimum and maximum of each pixel column
+#  Unlike taking every n-th sample, this keeps echoes narrower than a column.
+#  Traces with no more samples than columns come back unchanged.
+def column_envelope(data,columns):
+    columns=int(columns)
+    if len(data) <= columns:
+        return data,data
+    edges=(numpy.arange(columns)*len(data))//columns
+    return numpy.minimum.reduceat(data,edges),numpy.maximum.reduceat(data,edges)
+
+# Draw a min/max envelope as one zig-zag path, one column per pixel
+#  Values are heights above the bottom of a display height pixels tall.
+def draw_envelope(ctx,lo,hi,height):
+    ylo=(height-numpy.asarray(lo)).astype(int).tolist()
+    yhi=(height-numpy.asarray(hi)).astype(int).tolist()
+    ctx.new_path()
+    ctx.move_to(0,yhi[0])
+    for x in range(0,len(ylo)):
+        ctx.line_to(x,yhi[x])
+        if ylo[x] != yhi[x]:
+            ctx.line_to(x,ylo[x])
+    ctx.stroke()
+
+# Colour palettes as (level,red,green,blue) control points on 0-255
+palettes={'grey':[(0,0,0,0),(255,255,255,255)],
+          'hot':[(0,0,0,0),(96,255,0,0),(192,255,255,0),(255,255,255,255)],
+          'jet':[(0,0,0,128),(32,0,0,255),(96,0,255,255),(160,255,255,0),
+                 (224,255,0,0),(255,128,0,0)]}
+
+# 256 opaque ARGB32 pixels for a named palette, interpolated between its
+# control points
+def palette_pixels(name):
+    points=numpy.array(palettes[name],dtype=numpy.float64)
+    levels=numpy.arange(256)
+    pixels=numpy.full(256,0xFF000000,dtype=numpy.uint32)
+    for channel,shift in [(1,16),(2,8),(3,0)]:
+        value=numpy.interp(levels,points[:,0],points[:,channel])
+        pixels|=numpy.round(value).astype(numpy.uint32) << shift
+    return pixels
+
+# Magnitude to colour mapping through lookup tables
+#  A magnitude is quantized by the top 16 bits of its float32 representation
+#  (sign, exponent and 7 mantissa bits, so steps of under 0.04 dB), which
+#  index a table of colours built once from the dB mapping and palette:
+#      level = scale*log10(magnitude+floor)+offset, clipped to 0-255
+#  In relative mode the mean of log10(magnitude) over each image is taken
+#  away first, as relative_db does; only the 32768-entry colour table is
+#  rebuilt per image.  No log10 is taken per pixel, and working arrays are
+#  reused while the image shape stays the same.
+class levelMap:
+    def __init__(self,palette='grey',scale=60.0,offset=100.0,floor=0.0,relative=False):
+        self.scale=scale
+        self.offset=offset
+        self.relative=relative
+
+        # Magnitude at the middle of each quantization step
+        mags=((numpy.arange(32768,dtype=numpy.uint32) << 16) | 0x8000).view(numpy.float32)
+        mags=numpy.where(numpy.isfinite(mags),mags,numpy.finfo(numpy.float32).max).astype(numpy.float64)
+        self.logs=numpy.log10(numpy.maximum(mags+floor,1e-10)).astype(numpy.float32)
+
+        self.levels=numpy.zeros(32768)
+        self.codes=numpy.zeros(32768,dtype=numpy.intp)
+        self.lut=numpy.zeros(32768,dtype=numpy.uint32)
+        self.shape=None
+        self.set_palette(palette)
+
+    def set_palette(self,palette):
+        self.palette=palette_pixels(palette)
+        self.update()
+
+    # Rebuild the colour table, moving the dB scale down by scale*mean
+    def update(self,mean=0.0):
+        numpy.multiply(self.logs,self.scale,out=self.levels)
+        self.levels+=self.offset-self.scale*mean
+        numpy.clip(self.levels,0,255,out=self.levels)
+        numpy.copyto(self.codes,self.levels,casting='unsafe')
+        self.palette.take(self.codes,out=self.lut,mode='clip')
+
+    # Colour of the lowest level, for padding
+    def background(self):
+        return self.palette[0]
+
+    # Write the colours of abs(data) into out, a uint32 array of its shape
+    def render(self,data,out):
+        if self.shape != data.shape:
+            self.shape=data.shape
+            self.mags=numpy.zeros(data.shape,dtype=numpy.float32)
+            self.index=numpy.zeros(data.shape,dtype=numpy.intp)
+            self.scratch=numpy.zeros(data.shape,dtype=numpy.float32)
+        numpy.abs(data,out=self.mags,casting='unsafe')
+        numpy.right_shift(self.mags.view(numpy.uint32),16,out=self.index)
+        if self.relative:
+            self.logs.take(self.index,out=self.scratch,mode='clip')
+            self.update(self.scratch.mean(dtype=numpy.float64))
+        self.lut.take(self.index,out=out,mode='clip')
+
+# Image of a magnitude array kept in a persistent ARGB32 surface
+#  Each update renders into the same pixels, cropped to the surface, and
+#  drawing paints only the part last written.
+class levelImage:
+    def __init__(self,width,height,levels):
+        self.width=int(width)
+        self.height=int(height)
+        self.levels=levels
+        self.pixels=numpy.zeros((self.height,self.width),dtype=numpy.uint32)
+        import cairo # Only the surfaces need it; levelMap works headless
+        self.surface=cairo.ImageSurface.create_for_data(self.pixels,cairo.FORMAT_ARGB32,
+                                                        self.width,self.height,self.width*4)
+        self.rows=0
+        self.columns=0
+
+    def update(self,data):
+        data=data[:self.height,:self.width]
+        self.rows,self.columns=data.shape
+        self.levels.render(data,self.pixels[:self.rows,:self.columns])
+
+    def draw(self,ctx):
+        self.surface.mark_dirty()
+        ctx.save()
+        ctx.rectangle(0,0,self.columns,self.rows)
+        ctx.clip()
+        ctx.set_source_surface(self.surface,0,0)
+        ctx.paint()
+        ctx.restore()
+
+# Scrolling waterfall image kept in a persistent ARGB32 surface
+#  The surface memory is a numpy array used as a ring of rows.  Adding a
+#  row writes only that row, and drawing is two blits that put the newest
+#  row at the top and older rows below it.  Rows are magnitudes coloured
+#  by a levelMap.
+class waterfall:
+    def __init__(self,width,height,levels):
+        self.width=int(width)
+        self.height=int(height)
+        self.levels=levels
+        self.pixels=numpy.zeros((self.height,self.width),dtype=numpy.uint32)
+        import cairo
+        self.surface=cairo.ImageSurface.create_for_data(self.pixels,cairo.FORMAT_ARGB32,
+                                                        self.width,self.height,self.width*4)
+        self.row=0 # Ring index of the newest row
+
+    # Add a row at the top, scrolling everything else down
+    def push(self,values):
+        values=values[:self.width]
+        self.row=(self.row-1) % self.height
+        self.levels.render(values,self.pixels[self.row,:len(values)])
+        self.pixels[self.row,len(values):]=self.levels.background()
+
+    def clear(self):
+        self.pixels[:]=0
+        self.row=0
+
+    def draw(self,ctx):
+        self.surface.mark_dirty()
+        split=self.height-self.row # Display line where the ring wraps
+
+        ctx.save()
+        ctx.rectangle(0,0,self.width,split)
+        ctx.clip()
+        ctx.set_source_surface(self.surface,0,-self.row)
+        ctx.paint()
+        ctx.restore()
+
+        if self.row > 0:
+            ctx.save()
+            ctx.rectangle(0,split,self.width,self.row)
+            ctx.clip()
+            ctx.set_source_surface(self.surface,0,split)
+            ctx.paint()
+            ctx.restore()
@@ -0,0 +1,181 @@
+#
+# Growable session store for matfilter SNR readings
+#  Rows are kept in memory with amortized constant-time appends, and can be
+#  streamed to a compact binary log and exported as CSV off the GTK thread
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import os
+import json
+import time
+import queue
+import threading
+import numpy
+
+LOG_MAGIC=b'# snrlog '
+
+# Record layout for a bank of the given number of filters
+#  time is in seconds since the epoch, detected is the index of the filter
+#  that detected a pulse or -1, and snr holds one reading per filter.
+def snr_dtype(filters):
+    return numpy.dtype([('time','<f8'),('detected','<i4'),('snr','<f4',(filters,))])
+
+# SNR rows in a buffer that doubles when full
+#  While streaming to a log, rows go only to the log and are not kept.
+class snrStore:
+    def __init__(self,names,capacity=1024):
+        self.names=list(names)
+        self.dtype=snr_dtype(len(self.names))
+        self.rows=numpy.zeros(capacity,dtype=self.dtype)
+        self.count=0
+        self.writer=None
+
+    def __len__(self):
+        return self.count
+
+    def append(self,snrs,detected=-1,when=None):
+        writer=self.writer # close may clear it from another thread
+        if writer is not None:
+            row=numpy.zeros(1,dtype=self.dtype)
+        else:
+            if self.count == len(self.rows):
+                rows=numpy.zeros(2*len(self.rows),dtype=self.dtype)
+                rows[:self.count]=self.rows
+                self.rows=rows
+            row=self.rows[self.count:self.count+1]
+            self.count+=1
+        row['time']=time.time() if when is None else when
+        row['detected']=detected
+        row['snr']=snrs
+        if writer is not None:
+            writer.submit(row)
+
+    # Drop the newest row from memory (rows already streamed stay in the log)
+    def delete_last(self):
+        if self.count > 0:
+            self.count-=1
+
+    def clear(self):
+        self.count=0
+
+    # Stored rows, oldest first, as a view
+    def data(self):
+        return self.rows[:self.count]
+
+    # Stream every row appended from now on to a binary log
+    def stream(self,filename):
+        writer=logWriter(filename,self.names,self.dtype)
+        writer.start()
+        self.writer=writer
+
+    # Finish writing the log, if streaming
+    def close(self):
+        writer,self.writer=self.writer,None
+        if writer is not None:
+            writer.stop()
+
+    # One-line summary of the log for a status label, or '' if not streaming
+    def status(self):
+        writer=self.writer
+        return writer.status() if writer is not None else ''
+
+    # Write the stored rows as CSV with a header of filter names
+    #  The rows are copied before returning and written on a separate thread
+    #  unless background is False.
+    def export_csv(self,filename,background=True):
+        rows=self.data().copy()
+        header='time,detected,'+','.join(name.replace(',',' ') for name in self.names)
+        def write():
+            table=numpy.column_stack((rows['time'],rows['detected'],rows['snr']))
+            numpy.savetxt(filename,table,fmt=['%0.3f','%d']+['%2.4f']*len(self.names),
+                          delimiter=',',header=header,comments='')
+        if background:
+            thread=threading.Thread(target=write,name='export')
+            thread.start()
+            return thread
+        write()
+
+# Appends SNR rows to a binary log on its own thread
+#  The log is a one-line text header holding the filter names, padded to 64
+#  bytes, followed by packed records of snr_dtype; see read_log.  Rows are
+#  flushed whenever the queue runs dry, so the log is readable while it
+#  grows.  Rows that find the queue full, or arrive after stop, are dropped
+#  and counted.
+class logWriter(threading.Thread):
+    def __init__(self,filename,names,dtype,depth=1000):
+        threading.Thread.__init__(self,name='snrlog',daemon=True)
+        self.filename=filename
+        self.queue=queue.Queue(depth)
+        self.dropped=0
+        self.rows=0
+        self.stopped=False # Set under lock, so nothing is queued after the sentinel
+        self.lock=threading.Lock()
+        header=LOG_MAGIC+json.dumps({'filters':list(names)}).encode()
+        header+=b' '*(63-(len(header) % 64))+b'\n'
+        self.f=open(filename,'wb')
+        self.f.write(header)
+
+    def submit(self,row):
+        with self.lock:
+            if not self.stopped:
+                try:
+                    self.queue.put_nowait(row)
+                    return True
+                except queue.Full:
+                    pass
+            self.dropped+=1
+            return False
+
+    def run(self):
+        while True:
+            row=self.queue.get()
+            if row is None:
+                break
+            self.f.write(row.tobytes())
+            self.rows+=1
+            if self.queue.empty():
+                self.f.flush()
+        self.f.close()
+
+    def stop(self):
+        with self.lock:
+            self.stopped=True
+        self.queue.put(None)
+        self.join()
+
+    # One-line summary for a status label
+    def status(self):
+        return 'Logging %s  %d rows  Dropped %d' % (self.filename,self.rows,self.dropped)
+
+# Memory-map a binary SNR log, returning its records and filter names
+def read_log(filename):
+    with open(filename,'rb') as f:
+        header=f.readline()
+    if not header.startswith(LOG_MAGIC):
+        raise ValueError(filename + ' is not an SNR log')
+    names=json.loads(header[len(LOG_MAGIC):])['filters']
+    dtype=snr_dtype(len(names))
+    rows=(os.path.getsize(filename)-len(header))//dtype.itemsize
+    if rows == 0:
+        return numpy.zeros(0,dtype=dtype),names
+    return numpy.memmap(filename,dtype=dtype,mode='r',offset=len(header),shape=(rows,)),names
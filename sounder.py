@@ -31,8 +31,7 @@ gi.require_version("Gst","1.0")
 from gi.repository import GObject, Gtk, Gdk, Gst, GLib
 
 import time
-import struct
-import wave
+import argparse
 import numpy
 import scipy.io
 from math import sqrt
@@ -40,37 +39,83 @@ from numpy import conj
 from numpy.fft import fft, ifft
 from time import strftime
 
-def unpack(str,bytesPerSample=2):
-    result=list()
-    for i in range(0,len(str)-1,bytesPerSample):
-        result.append(struct.unpack('h',str[i:i+bytesPerSample])[0])
-    return result
+from dsp import rangeProfile, relative_db
+from engine import pulseTrain, bufferPool, dspWorker, frameAssembler, capture_stamp, deinterleave, continuityTracker, captureRecorder, replaySource
+from metrics import stageMetrics
+from render import column_envelope, draw_envelope
+from wavio import load_reference
 
 class sounder:
     def delete_event(self, event, data=None):
         return False
 
     def destroy_event(self, data=None):
-        # Apparently, the application crashes intermittently if I try to clean up 
-        # gstreamer nicely.  I think there might be a deadlock since the tx pipeline 
-        # gets re-seeked frequently.  In any event, it's apparently mostly OK to 
-        # let the gc do the cleanup work for me, though this occasionally segfaults...
+        # The transmitter no longer re-seeks a decoder, so both pipelines can
+        # be shut down cleanly
+        self.txpipeline.set_state(Gst.State.NULL)
+        self.rxpipeline.set_state(Gst.State.NULL)
+        self.worker.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
         Gtk.main_quit()
 
     def trigger_update(self):
+        if self.replay is not None:
+            self.seekbar.set_value(self.replay.time())
         rect=self.screen.get_allocation()
         self.window.get_window().invalidate_rect(rect,True)
         return True
 
+    # Account for samples lost before the next buffer (runs on the DSP worker thread)
+    def gap_cb(self,frames):
+        if self.gapPolicy != 'ignore':
+            self.chain.skip(frames,self.gapPolicy == 'zero')
+
+    # Start over after a break in the stream, such as a replay seek (runs on
+    # the DSP worker thread)
+    def restart_cb(self):
+        self.chain.skip(0,False)
+
+    # Process one buffer of samples (runs on the DSP worker thread)
+    def process(self,samples):
+        self.metrics.tick('buffers')
+        profile=self.chain.process(deinterleave(samples,self.channels))
+
+        with self.metrics.stage('render'):
+            # Show one channel, or the mean magnitude of them all
+            if profile.ndim > 1:
+                profile=abs(profile).mean(axis=0) if self.channel is None else profile[self.channel]
+
+            # Convert to dB and crop
+            data=relative_db(profile)
+            data[data<-10]=-10
+            data[data>500]=500
+            data=data+20
+
+            # Reduce to the extremes of each pixel column
+            columns=-(-len(data)//self.get_step())
+            return column_envelope(data,columns)
+
+    # Draw the display, timing it and adding the metrics overlay if enabled
+    def draw_cb(self,widget,ctx):
+        with self.metrics.stage('draw'):
+            self.update_display(widget,ctx)
+        self.metrics.tick('frames')
+        latency=self.worker.displayed()
+        if latency is not None:
+            self.metrics.stage('latency').add(latency)
+
+        if self.metricscheck.get_active():
+            ctx.set_source_rgb(1,1,0)
+            ctx.set_font_size(11)
+            ctx.select_font_face('Monospace', cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_NORMAL)
+            for i,line in enumerate(self.metrics.lines()):
+                ctx.move_to(10,self.screenHeight-10-14*i)
+                ctx.show_text(line)
+        return True
+
     def update_display(self,widget,ctx):
        
-        # Update the data area
-        self.dataBlock=numpy.concatenate((self.dataBlock[int(self.blockSize/2):],self.data))
-
-        # Correlate against chirp reference
-        if self.matchedcheck.get_active():
-            self.dataBlock=ifft(fft(self.dataBlock)*self.ref*4/self.blockSize**2);
-
         # Erase current display
         ctx.set_source_rgb(0,0,0)
         ctx.rectangle(0,0,self.screenWidth,self.screenHeight)
@@ -78,40 +123,24 @@ class sounder:
 
         ctx.set_source_rgb(1,1,1)
 
-        # Trigger if desired
-        if self.centercheck.get_active():
-            idx=numpy.argmax(abs(self.dataBlock))
-        else:
-            idx=0
-
-        # Align and downsample pulses
-        if self.averagecheck.get_active():
-            self.corr_data=numpy.roll(self.corr_data,1,axis=1)
-            self.corr_data[:,0]=numpy.roll(abs(self.dataBlock),-idx,axis=0)
-            plotdat=numpy.mean(self.corr_data[::self.get_step(),:],1)
-        else:
-            self.corr_data=numpy.roll(self.dataBlock,-idx,axis=0)
-            plotdat=self.corr_data[::self.get_step()]
+        status=self.worker.status()+'\n'+self.continuity.status()+'\n'+self.pool.status()
+        if self.recorder is not None:
+            status+='\n'+self.recorder.status()
+        self.status.set_text(status)
 
-        # Convert to dB and crop        
-        plotdat[plotdat==0]=1e-10
-        dbdat=numpy.log10(abs(plotdat))
-        data=60*dbdat+100-60*numpy.mean(dbdat)
-        data[data<-10]=-10
-        data[data>500]=500
-        data=data+20
+        # Pick up the latest processed pulse
+        if self.worker.latest is None:
+            return True
+        lo,hi=self.worker.latest
 
-        self.data_snapshot = data
+        self.data_snapshot = hi
 
-        if self.cluttermap is not None:
-            data=data-self.cluttermap
+        if self.cluttermap is not None and len(self.cluttermap) == len(hi):
+            lo=lo-self.cluttermap
+            hi=hi-self.cluttermap
 
         # Plot the echo data
-        ctx.new_path()
-        ctx.move_to(0,int(self.screenHeight-data[0]))
-        for i2,e in enumerate(data):
-            ctx.line_to(i2,int(self.screenHeight-e))
-        ctx.stroke()            
+        draw_envelope(ctx,lo,hi,self.screenHeight)
         
         # Text labels
         for i in range(1,int(self.screenWidth/50)):
@@ -150,35 +179,55 @@ class sounder:
         return rangePixels*samples2cm*self.get_step()
 
     ## GStreamer callbacks
-    # Assemble the transmit pipeline as it gets linked together
-    def new_decoded_cb(self,element,pad):
-        decode=pad.get_parent()
-        pipeline=decode.get_parent()
-        sink=pipeline.get_by_name("out")
-        pad.link(sink.get_static_pad('sink'))
-
-    # Restart the txpipeline after on bank of pulses has been transmitted
-    def tx_cb(self,bus,message):
-        t=message.type
-        if t==Gst.MessageType.EOS:
-            self.txpipeline.seek_simple(Gst.Format.TIME,Gst.SeekFlags.FLUSH, 0)
-        return True
+    # Push the next chunk of the pulse train whenever appsrc runs low
+    def need_data_cb(self,src,length):
+        data,offset=self.transmit.next()
+        buffer=Gst.Buffer.new_wrapped(data)
+        buffer.pts=self.transmit.time(offset)
+        buffer.duration=self.transmit.time(offset+self.transmit.frames)-buffer.pts
+        buffer.offset=offset
+        buffer.offset_end=offset+self.transmit.frames
+        src.emit('push-buffer',buffer)
 
     # Unpack data from gstreamer
     def buffer_cb(self, sink):
-        # Unpack and FFT data
-        sample=sink.emit('pull-sample')
-        buffer=sample.get_buffer()
-        self.data=numpy.frombuffer(buffer.extract_dup(0,buffer.get_size()),
-                                   dtype=numpy.int16)
+        with self.metrics.stage('capture'):
+            # Copy the samples out of the buffer into a pooled array
+            sample=sink.emit('pull-sample')
+            buffer=sample.get_buffer()
+            ok,info=buffer.map(Gst.MapFlags.READ)
+            if not ok:
+                return Gst.FlowReturn.OK
+            try:
+                samples=self.pool.fill(info.data)
+            finally:
+                buffer.unmap(info)
+            gap=self.continuity.check(buffer.pts,buffer.duration,buffer.offset,len(samples)//self.channels,
+                                      buffer.has_flags(Gst.BufferFlags.DISCONT))
+            clock=sink.get_clock()
+            running=clock.get_time()-sink.get_base_time() if clock is not None else None
+            stamp=capture_stamp(running,buffer.pts,buffer.duration)
+
+            recorder=self.recorder
+            if recorder is not None:
+                self.pool.hold(samples)
+                recorder.submit(samples,buffer.pts)
+            self.assembler.submit(samples,gap=gap,stamp=stamp)
 
         return Gst.FlowReturn.OK
 
 
     ## UI callbacks
+    # Copy the check boxes into plain attributes the DSP worker can read
+    def controls_cb(self,event):
+        self.chain.matched=self.matchedcheck.get_active()
+        self.chain.averaging=self.averagecheck.get_active()
+        self.chain.centering=self.centercheck.get_active()
+        return True
+
     def average_cb(self,event):
-        self.corr_data=[]
-        self.corr_data=numpy.zeros((int(self.blockSize/2*self.blocks),self.averagingWindow))
+        with self.worker.lock:
+            self.chain.reset(self.averagingWindow)
         return True
 
     def avg_up(self,event):
@@ -204,11 +253,24 @@ class sounder:
     def saveButton(self,event):
         # Obtain date and time
         filename=strftime("%Y%m%d%H%M%S.mat")
-        scipy.io.savemat(filename,{'corr_data':self.corr_data,
-                                   'blockSize':self.blockSize,
-                                   'averagingWindow':self.averagingWindow,
-                                   'sampleRate':self.sampleRate,
-                                   'blocks':self.blocks})
+        with self.worker.lock:
+            scipy.io.savemat(filename,{'corr_data':self.chain.corr_data,
+                                       'blockSize':self.blockSize,
+                                       'averagingWindow':self.averagingWindow,
+                                       'sampleRate':self.sampleRate,
+                                       'blocks':self.blocks})
+        return True
+
+    # Start or stop streaming raw captured samples to disk
+    def record_cb(self,event):
+        if self.recordbutton.get_active():
+            recorder=captureRecorder(strftime("%Y%m%d%H%M%S.wav"),self.sampleRate,self.channels,pool=self.pool)
+            recorder.start()
+            self.recorder=recorder
+        elif self.recorder is not None:
+            recorder=self.recorder
+            self.recorder=None
+            recorder.stop()
         return True
 
     def transmit_cb(self,event):
@@ -242,18 +304,54 @@ class sounder:
             self.height=data.height
         return True
 
-    def __init__(self):
+    def __init__(self,replay=None,speed=1.0,gapPolicy='zero',
+                 captureBlock=None,bufferTime=None,latencyTime=None,channels=1):
         self.window = Gtk.Window()
 
         # Transform parameters
         self.sampleRate=44100
         self.blockSize=3000*self.sampleRate/44100
         self.blocks=1
-        self.dataBlock=numpy.zeros(int(self.blocks*self.blockSize/2))
+        self.channels=channels # Interleaved capture channels, processed together
+        self.channel=None # Channel on display, None for the mean of all
         self.averagingWindow=10
-        self.corr_data=numpy.zeros((int(self.blockSize/2*self.blocks),self.averagingWindow))
         self.cluttermap=None
 
+        # Load the chirp once; it is both the transmitted pulse, repeated every
+        # block, and the matched filter reference
+        self.transmit=pulseTrain(load_reference("squeak.wav"),int(self.blockSize/2),self.sampleRate)
+        self.chain=rangeProfile(self.transmit.reference(),self.blockSize,self.blocks,self.averagingWindow,
+                                channels if channels > 1 else None)
+
+        # Processing runs on its own thread, fed by buffer_cb
+        self.pool=bufferPool(int(self.blockSize/2)*self.channels)
+        self.worker=dspWorker(self.process,gap=self.gap_cb,pool=self.pool,channels=self.channels,
+                              restart=self.restart_cb)
+        self.continuity=continuityTracker(self.sampleRate)
+        self.gapPolicy=gapPolicy # What to do about lost samples: zero, resync or ignore
+
+        # Capture settings, independent of the pulse length: pulsesrc
+        # delivers captureBlock bytes per channel at a time, and the chain
+        # cuts them into pulses itself, so buffers go to the worker whole
+        self.captureBlock=int(captureBlock or self.blockSize)
+        self.bufferTime=bufferTime # pulsesrc buffer-time in microseconds, None for its default
+        self.latencyTime=latencyTime # pulsesrc latency-time in microseconds, None for its default
+        self.assembler=frameAssembler(self.worker,int(self.captureBlock/2),None,
+                                      self.sampleRate,self.pool,channels=self.channels)
+
+        # Stage timings, shown with the Metrics box and served by --metrics-port
+        self.metrics=stageMetrics()
+        self.metrics.watch(self.worker)
+        self.chain.metrics=self.metrics
+        self.recorder=None # captureRecorder while recording
+
+        # Replay a recording in place of the sound card, if given one
+        self.replay=None
+        if replay is not None:
+            self.replay=replaySource(replay,self.assembler,int(self.captureBlock/2)*self.channels,speed,
+                                     0 if self.channels == 1 else None,self.sampleRate,
+                                     self.channels)
+
         # Window boilerplate
         self.window.set_title("Sounder")
         self.window.connect("delete_event",self.delete_event)
@@ -269,23 +367,22 @@ class sounder:
         self.screenHeight=380
         self.screen.set_size_request(self.screenWidth,self.screenHeight)
         self.zoom=1
-        self.screen.connect("draw",self.update_display)
-
-        # Load chirp reference
-        f=wave.open("squeak.wav",'r')
-        wavdata=unpack(f.readframes(f.getnframes()),f.getsampwidth())
-        self.ref=numpy.conjugate(fft(wavdata,self.blockSize/2*self.blocks))
+        self.screen.connect("draw",self.draw_cb)
 
         # Construct gstreamer receiver pipeline to funnel data into the application
         # pulsesrc ! capsfilter ! appsink ! (this program)
         self.rxpipeline=Gst.Pipeline.new("rxpipeline")
 
         rxsrc=Gst.ElementFactory.make("pulsesrc", "src")
-        rxsrc.set_property("blocksize",self.blockSize)
+        rxsrc.set_property("blocksize",self.captureBlock*self.channels)
+        if self.bufferTime:
+            rxsrc.set_property("buffer-time",self.bufferTime)
+        if self.latencyTime:
+            rxsrc.set_property("latency-time",self.latencyTime)
         self.rxpipeline.add(rxsrc)
 
         ac=Gst.ElementFactory.make("capsfilter","ac")
-        ac.set_property("caps",Gst.caps_from_string("audio/x-raw,format=S16LE,rate="+ str(self.sampleRate) + ",channels=1"))
+        ac.set_property("caps",Gst.caps_from_string("audio/x-raw,format=S16LE,rate="+ str(self.sampleRate) + ",channels=" + str(self.channels)))
         self.rxpipeline.add(ac)
 
         sink=Gst.ElementFactory.make("appsink","as")
@@ -301,21 +398,17 @@ class sounder:
         # Construct gstreamer pipeline for transmission
         self.txpipeline=Gst.Pipeline.new("txpipeline")
         
-        txsrc=Gst.ElementFactory.make("filesrc","txsrc")
-        txsrc.set_property("location","squeaks.wav")
+        # appsrc ! pulsesink, fed the pulse train by need_data_cb
+        txsrc=Gst.ElementFactory.make("appsrc","txsrc")
+        txsrc.set_property("caps",Gst.caps_from_string("audio/x-raw,format=S16LE,layout=interleaved,rate="+ str(self.sampleRate) + ",channels=1"))
+        txsrc.set_property("format",Gst.Format.TIME)
+        txsrc.set_property("max-bytes",2*len(self.transmit.chunk))
+        txsrc.connect("need-data",self.need_data_cb)
         self.txpipeline.add(txsrc)
 
-        wd=Gst.ElementFactory.make("decodebin","wd")
-        self.txpipeline.add(wd)
-        txsrc.link(wd)
-        wd.connect("pad-added", self.new_decoded_cb)
-
         sink2=Gst.ElementFactory.make("pulsesink","out")
         self.txpipeline.add(sink2)
-
-        bus=self.txpipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message",self.tx_cb)
+        txsrc.link(sink2)
 
         # Organization on window...
         hbox=Gtk.HBox(homogeneous=False,spacing=10)
@@ -325,10 +418,12 @@ class sounder:
         self.matchedcheck=Gtk.CheckButton(label='Matched filter')
         self.matchedcheck.set_active(True)
         self.matchedcheck.connect('toggled',self.average_cb)
+        self.matchedcheck.connect('toggled',self.controls_cb)
         vbox.pack_start(self.matchedcheck,True,True,0)
         self.averagecheck=Gtk.CheckButton(label='Averaging')
         self.averagecheck.set_active(True)
         self.averagecheck.connect('toggled',self.average_cb)
+        self.averagecheck.connect('toggled',self.controls_cb)
         vbox.pack_start(self.averagecheck,True,True,0)
         self.transmitcheck=Gtk.CheckButton(label='Transmit')
         self.transmitcheck.set_active(False)
@@ -336,11 +431,39 @@ class sounder:
         vbox.pack_start(self.transmitcheck,True,True,0)
         self.centercheck=Gtk.CheckButton(label='Center');
         self.centercheck.set_active(True)
+        self.centercheck.connect('toggled',self.controls_cb)
         vbox.pack_start(self.centercheck,True,True,0)
         self.cluttercheck=Gtk.CheckButton(label='Clutter map');
         self.cluttercheck.set_active(False)
         self.cluttercheck.connect('toggled',self.clutter_cb)
         vbox.pack_start(self.cluttercheck,True,True,0)
+        self.controls_cb(None)
+        self.status=Gtk.Label(label='')
+        vbox.pack_start(self.status,True,True,0)
+        self.metricscheck=Gtk.CheckButton(label='Metrics')
+        self.metricscheck.set_active(False)
+        vbox.pack_start(self.metricscheck,True,True,0)
+
+        # Channel shown from a multi-channel capture
+        if self.channels > 1:
+            self.channelcombo=Gtk.ComboBoxText()
+            self.channelcombo.append_text('All channels')
+            for i in range(0,self.channels):
+                self.channelcombo.append_text('Channel %d' % (i+1))
+            self.channelcombo.set_active(0)
+            self.channelcombo.connect('changed',self.channel_cb)
+            vbox.pack_start(self.channelcombo,True,True,0)
+
+        # Replay position and pause
+        if self.replay is not None:
+            hbox2=Gtk.HBox(homogeneous=False,spacing=0)
+            self.seekbar=Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL,0,max(self.replay.duration(),0.1),0.1)
+            self.seekbar.connect('change-value',self.seek_cb)
+            hbox2.pack_start(self.seekbar,True,True,0)
+            button=Gtk.ToggleButton(label='Pause')
+            button.connect('toggled',self.pause_cb)
+            hbox2.pack_start(button,False,False,0)
+            vbox.pack_start(hbox2,True,True,0)
         
         hbox2=Gtk.HBox(homogeneous=True,spacing=0)
         button=Gtk.Button(label='AVG+')
@@ -351,6 +474,10 @@ class sounder:
         hbox2.pack_start(button,True,True,0)
         vbox.pack_end(hbox2,True,True,0)
 
+        self.recordbutton=Gtk.ToggleButton(label='Record')
+        self.recordbutton.connect('toggled',self.record_cb)
+        vbox.pack_end(self.recordbutton,True,True,0)
+
         button=Gtk.Button(label='Save')
         button.connect('clicked',self.saveButton)
         vbox.pack_end(button,True,True,0)
@@ -362,20 +489,55 @@ class sounder:
         self.window.show_all()
 
         # Turn on receiver chain
-        self.rxpipeline.set_state(Gst.State.PLAYING) 
+        self.worker.start()
+        if self.replay is not None:
+            self.replay.start()
+        else:
+            self.rxpipeline.set_state(Gst.State.PLAYING)
 
         # Wait to start transmitting until the pipeline is fully assembled
         self.txpipeline.set_state(Gst.State.PAUSED)  
 
-        self.data=numpy.zeros(self.dataBlock.shape)
         GLib.timeout_add(50,self.trigger_update)
         return
 
+    def channel_cb(self,widget):
+        active=self.channelcombo.get_active()
+        self.channel=None if active == 0 else active-1
+        return True
+
+    # Replay controls
+    def seek_cb(self,widget,scroll,value):
+        self.replay.seek(value)
+        return False
+
+    def pause_cb(self,widget):
+        self.replay.pause(widget.get_active())
+        return True
+
     def main(self):
         Gtk.main()
         return 0
 
 if __name__ == "__main__":
+    parser=argparse.ArgumentParser(description='Sonar range profiler')
+    parser.add_argument('--replay',metavar='WAV',help='process a recording instead of the sound card')
+    parser.add_argument('--speed',type=float,default=1.0,help='replay speed as a multiple of real time, 0 for as fast as possible')
+    parser.add_argument('--on-gap',choices=['zero','resync','ignore'],default='zero',
+                        help='treat lost samples as silence, restart the history, or ignore them')
+    parser.add_argument('--capture-block',type=int,help='bytes per channel in each capture buffer (default: the transform size)')
+    parser.add_argument('--buffer-time',type=int,help='pulsesrc buffer time in microseconds')
+    parser.add_argument('--latency-time',type=int,help='pulsesrc latency time in microseconds')
+    parser.add_argument('--channels',type=int,default=1,help='capture channels, processed together')
+    parser.add_argument('--metrics-port',type=int,help='serve stage metrics as JSON on this local port')
+    parser.add_argument('--metrics-csv',metavar='FILE',help='log stage metrics to a CSV file every second')
+    args=parser.parse_args()
+
     Gst.init(None)
-    sounderob=sounder()
+    sounderob=sounder(args.replay,args.speed,args.on_gap,
+                     args.capture_block,args.buffer_time,args.latency_time,args.channels)
+    if args.metrics_port:
+        sounderob.metrics.serve(args.metrics_port)
+    if args.metrics_csv:
+        sounderob.metrics.log(args.metrics_csv)
     sounderob.main()
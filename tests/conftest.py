@@ -0,0 +1,5 @@
+# The tools are modules at the top of the tree rather than a package
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,56 @@
+import numpy
+import pytest
+
+from engine import bufferPool, frameAssembler
+
+# Worker that keeps a copy of every frame and the gap reported with it
+class collector:
+    def __init__(self,pool=None):
+        self.pool=pool
+        self.frames=[]
+        self.gaps=[]
+
+    def submit(self,samples,block=False,gap=0,stamp=None,restart=False):
+        self.frames.append(numpy.array(samples))
+        self.gaps.append(gap)
+        if self.pool is not None:
+            self.pool.release(samples)
+        return True
+
+@pytest.mark.parametrize('hop',[None,40,100,7])
+@pytest.mark.parametrize('channels',[1,3])
+@pytest.mark.parametrize('pooled',[False,True])
+def test_matches_direct_slicing(hop,channels,pooled):
+    rng=numpy.random.default_rng(0)
+    pool=bufferPool() if pooled else None
+    worker=collector(pool)
+    assembler=frameAssembler(worker,100,hop,44100,pool,channels=channels)
+    stream=numpy.arange(5000*channels,dtype=numpy.int16)
+
+    # Buffers of random whole frames of samples, and some of exactly one frame
+    sizes=list(rng.integers(1,250,30))+[100]*5
+    pos=0
+    for size in sizes:
+        buffer=stream[pos:pos+size*channels]
+        if pool is not None:
+            buffer=pool.fill(buffer.tobytes())
+        assembler.submit(buffer)
+        pos+=size*channels
+
+    step=(hop or 100)*channels
+    starts=range(0,pos-100*channels+1,step)
+    assert len(worker.frames) == len(starts)
+    for frame,start in zip(worker.frames,starts):
+        numpy.testing.assert_array_equal(frame,stream[start:start+100*channels])
+    assert not any(worker.gaps)
+    if pool is not None:
+        assert pool.users == {}
+
+def test_gap_restarts_assembly():
+    worker=collector()
+    assembler=frameAssembler(worker,100,50,channels=2)
+    stream=numpy.arange(1000,dtype=numpy.int16)
+    assembler.submit(stream[:260]) # One frame, and 30 frames never in one
+    assembler.submit(stream[400:700],gap=70)
+    assert [int(frame[0]) for frame in worker.frames] == [0,400,500]
+    assert worker.gaps == [0,70+30,0]
@@ -0,0 +1,64 @@
+import numpy
+import pytest
+
+from dsp import rangeDoppler
+
+# Slow-time DFT of the oldest-first history at -span*(i*rowstep-rows//2)/rows
+# cycles per pulse for row i, on every step-th range gate
+def reference(doppler,step=1,rows=None,rowstep=1,span=1.0):
+    oldest=doppler.history.ordered()[::-1]
+    rows=rows or len(oldest)
+    freqs=span*(numpy.arange(0,rows,rowstep)-rows//2)/float(rows)
+    kernel=numpy.exp(2j*numpy.pi*numpy.outer(freqs,numpy.arange(len(oldest))))
+    return numpy.tensordot(kernel,oldest[:,::step],axes=1)
+
+# The same over the full view, from an FFT of the oldest-first history
+def full_spectrum(oldest):
+    return numpy.fft.fftshift(len(oldest)*numpy.fft.ifft(oldest,axis=0),axes=0)
+
+def chain(window,length=60,channels=None):
+    doppler=rangeDoppler(numpy.ones(8),2*length,1,window,channels)
+    doppler.resyncInterval=7 # Resync often enough to be exercised
+    return doppler
+
+@pytest.mark.parametrize('window',[16,15])
+def test_full_view_matches_fft(window):
+    rng=numpy.random.default_rng(0)
+    doppler=chain(window)
+    for i in range(50):
+        doppler.add(rng.standard_normal(doppler.length))
+        spectrum=doppler.image()
+        expected=full_spectrum(doppler.history.ordered()[::-1])
+        numpy.testing.assert_allclose(spectrum,expected,atol=1e-9)
+
+def test_sliding_matches_direct_dft():
+    rng=numpy.random.default_rng(1)
+    doppler=chain(24)
+    view=dict(step=3,rows=20,rowstep=2,span=0.5)
+    for i in range(60):
+        doppler.add(rng.standard_normal(doppler.length))
+        spectrum=doppler.image(**view)
+        numpy.testing.assert_allclose(spectrum,reference(doppler,**view),atol=1e-9)
+
+def test_unread_map_is_rebuilt():
+    rng=numpy.random.default_rng(2)
+    pulses=rng.standard_normal((40,60))
+    live=chain(16)
+    offline=chain(16)
+    for i,pulse in enumerate(pulses):
+        live.add(pulse)
+        live.image()
+        offline.add(pulse)
+        if i == 5:
+            offline.image()
+    assert live.spectrum is not None
+    numpy.testing.assert_allclose(offline.image(),live.image(),atol=1e-9)
+
+def test_channel_view():
+    rng=numpy.random.default_rng(3)
+    doppler=chain(12,channels=3)
+    for i in range(30):
+        doppler.add(rng.standard_normal((3,doppler.length)))
+        spectrum=doppler.image(channel=1)
+        expected=full_spectrum(doppler.history.ordered()[::-1,1])
+        numpy.testing.assert_allclose(spectrum,expected,atol=1e-9)
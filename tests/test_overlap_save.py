@@ -0,0 +1,46 @@
+import numpy
+import pytest
+
+import dsp
+from dsp import overlapSave
+
+# Output sample k correlates the reference with the input from len(ref)-1
+# samples before it, the stream taken as silent before its start
+def reference(stream,ref):
+    padded=numpy.concatenate((numpy.zeros(stream.shape[:-1]+(len(ref)-1,)),stream),axis=-1)
+    if stream.ndim == 1:
+        return numpy.correlate(padded,ref,'valid')
+    return numpy.array([numpy.correlate(row,ref,'valid') for row in padded])
+
+@pytest.mark.parametrize('real',[True,False])
+@pytest.mark.parametrize('channels',[None,3])
+def test_matches_direct_correlation(monkeypatch,real,channels):
+    monkeypatch.setattr(dsp,'realTransforms',real)
+    rng=numpy.random.default_rng(0)
+    ref=rng.standard_normal(37)
+    shape=() if channels is None else (channels,)
+    stream=rng.standard_normal(shape+(11000,))
+    correlator=overlapSave(ref,100,channels=channels)
+
+    # Buffers of random sizes, including empty, sub-hop and multi-hop ones
+    # and exactly one hop at a time
+    sizes=list(rng.integers(0,350,30))+[100]*5
+    pos=0
+    output=[]
+    for size in sizes:
+        output.append(correlator.process(stream[...,pos:pos+size]))
+        pos+=size
+    output=numpy.concatenate(output,axis=-1)
+    assert output.shape[-1] == pos//100*100
+    expected=reference(stream[...,:pos],ref)[...,:output.shape[-1]]
+    numpy.testing.assert_allclose(output,expected,atol=1e-12*numpy.abs(expected).max())
+
+def test_reset_restarts_from_silence():
+    rng=numpy.random.default_rng(1)
+    ref=rng.standard_normal(20)
+    stream=rng.standard_normal(400)
+    correlator=overlapSave(ref,50)
+    correlator.process(rng.standard_normal(130))
+    correlator.reset()
+    output=correlator.process(stream)
+    numpy.testing.assert_allclose(output,reference(stream,ref),atol=1e-12)
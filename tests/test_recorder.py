@@ -0,0 +1,23 @@
+import numpy
+
+import wavio
+from engine import bufferPool, captureRecorder
+
+def test_recorder_releases_buffers(tmp_path):
+    filename=str(tmp_path/'capture.wav')
+    pool=bufferPool()
+    recorder=captureRecorder(filename,44100,pool=pool)
+    recorder.start()
+    for i in range(3):
+        samples=pool.fill(numpy.full(100,i,dtype=numpy.int16).tobytes())
+        assert recorder.submit(samples,i)
+    recorder.stop()
+    late=pool.fill(numpy.zeros(100,dtype=numpy.int16).tobytes())
+    assert not recorder.submit(late)
+
+    # Every buffer, written or not, is back in the pool
+    assert pool.users == {}
+    assert len(pool.free[100]) == pool.allocations
+    data,rate,index=wavio.read_capture(filename)
+    numpy.testing.assert_array_equal(data,numpy.repeat([0,1,2],100))
+    numpy.testing.assert_array_equal(index['pts'],[0,1,2])
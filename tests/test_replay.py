@@ -0,0 +1,100 @@
+import struct
+import threading
+import numpy
+import pytest
+
+import wavio
+from engine import frameAssembler, replaySource
+
+# Worker that keeps every buffer submitted and signals once it has count samples
+class collector:
+    def __init__(self,count):
+        self.count=count
+        self.buffers=[]
+        self.restarts=[]
+        self.done=threading.Event()
+
+    def submit(self,samples,block=False,gap=0,stamp=None,restart=False):
+        self.buffers.append(numpy.array(samples))
+        self.restarts.append(restart)
+        if sum(len(b) for b in self.buffers) >= self.count:
+            self.done.set()
+        return True
+
+def write_wav(filename,data,rate,width,tag=wavio.WAVE_FORMAT_PCM):
+    body=data.tobytes()
+    with open(filename,'wb') as f:
+        f.write(struct.pack('<4sI4s4sIHHIIHH4sI',b'RIFF',36+len(body),b'WAVE',
+                            b'fmt ',16,tag,1,rate,rate*width,width,8*width,b'data',len(body)))
+        f.write(body)
+
+def replay(filename,frames,rate=44100):
+    worker=collector(frames)
+    source=replaySource(filename,worker,100,speed=0,rate=rate)
+    source.start()
+    assert worker.done.wait(5)
+    return numpy.concatenate(worker.buffers)[:frames]
+
+expected=numpy.array([0,1000,-1000,32767,-32768]*40,dtype=numpy.int16)
+
+def test_replay_24_bit(tmp_path):
+    wide=expected.astype(numpy.int32) << 8 | 0x55 # Low byte below 16-bit resolution
+    raw=wide.astype('<i4').view(numpy.uint8).reshape(-1,4)[:,:3]
+    filename=str(tmp_path/'wide.wav')
+    write_wav(filename,numpy.ascontiguousarray(raw),44100,3)
+    samples=replay(filename,len(expected))
+    assert samples.dtype == numpy.int16
+    numpy.testing.assert_array_equal(samples,expected)
+
+def test_replay_float(tmp_path):
+    filename=str(tmp_path/'float.wav')
+    data=numpy.array([0.0,0.5,-0.5,1.0,-2.0]*40,dtype='<f4')
+    write_wav(filename,data,44100,4,wavio.WAVE_FORMAT_IEEE_FLOAT)
+    samples=replay(filename,len(data))
+    assert samples.dtype == numpy.int16
+    numpy.testing.assert_array_equal(samples,[0,16384,-16384,32767,-32768]*40)
+
+def test_replay_rejects_rate(tmp_path):
+    filename=str(tmp_path/'slow.wav')
+    write_wav(filename,expected,22050,2)
+    with pytest.raises(ValueError,match='22050'):
+        replaySource(filename,collector(1),100,rate=44100)
+
+def test_replay_rejects_channels(tmp_path):
+    mono=str(tmp_path/'mono.wav')
+    write_wav(mono,expected,44100,2)
+    with pytest.raises(ValueError,match='1 channels, not 4'):
+        replaySource(mono,collector(1),400,channel=None,channels=4)
+
+    three=str(tmp_path/'three.wav')
+    data=numpy.zeros(300,dtype='<i2')
+    with open(three,'wb') as f:
+        wavio.write_header(f,44100,3,2,len(data)*2)
+        f.write(data.tobytes())
+    with pytest.raises(ValueError,match='3 channels, not 2'):
+        replaySource(three,collector(1),200,channel=None,channels=2)
+    assert replaySource(three,collector(1),100,channel=0,channels=1).channels == 1
+
+def test_replay_seek_restarts(tmp_path):
+    filename=str(tmp_path/'ramp.wav')
+    write_wav(filename,numpy.arange(1000,dtype='<i2'),1000,2)
+    worker=collector(4*150)
+    source=replaySource(filename,frameAssembler(worker,150),100,speed=0)
+    source.pause()
+    source.start()
+    source.seek(0.25)
+    source.pause(False)
+    assert worker.done.wait(5)
+
+    # Frames start at the seek, and only the first follows a break
+    starts=[int(b[0]) for b in worker.buffers]
+    assert starts[:4] == [250,400,550,700]
+    assert worker.restarts[:4] == [True,False,False,False]
+
+    # After the end, the part-built frame is dropped and the next restarts
+    worker.count+=150
+    worker.done.clear()
+    source.seek(0.1)
+    assert worker.done.wait(5)
+    assert int(worker.buffers[4][0]) == 100
+    assert worker.restarts[4]
@@ -0,0 +1,31 @@
+import numpy
+
+from session import read_log, snrStore
+
+def test_streamed_rows_go_only_to_the_log(tmp_path):
+    filename=str(tmp_path/'session.snr')
+    store=snrStore(['a','b'])
+    store.stream(filename)
+    for i in range(5):
+        store.append([i,-i],i % 2,when=float(i))
+    assert len(store) == 0
+    assert 'Dropped 0' in store.status()
+    writer=store.writer
+    store.close()
+    assert store.status() == ''
+
+    # Rows arriving after the log is closed are counted, not lost silently
+    assert not writer.submit(numpy.zeros(1,dtype=store.dtype))
+    assert writer.dropped == 1
+
+    rows,names=read_log(filename)
+    assert names == ['a','b']
+    numpy.testing.assert_array_equal(rows['time'],numpy.arange(5))
+    numpy.testing.assert_array_equal(rows['detected'],[0,1,0,1,0])
+    numpy.testing.assert_array_equal(rows['snr'][:,1],-numpy.arange(5))
+
+def test_unstreamed_rows_are_kept():
+    store=snrStore(['a'],capacity=2)
+    for i in range(3):
+        store.append([i])
+    numpy.testing.assert_array_equal(store.data()['snr'][:,0],[0,1,2])
@@ -0,0 +1,38 @@
+import time
+import numpy
+
+from engine import bufferPool, dspWorker
+
+def test_worker_survives_exceptions(capsys):
+    pool=bufferPool()
+    def process(samples):
+        if samples[0] == 1:
+            raise ValueError('bad buffer')
+        return int(samples[0])
+    worker=dspWorker(process,pool=pool)
+    worker.start()
+    for value in [0,1,2]:
+        assert worker.submit(pool.fill(numpy.full(10,value,dtype=numpy.int16).tobytes()),block=True)
+    deadline=time.time()+5
+    while worker.processed < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    worker.stop()
+    worker.join(5)
+
+    assert worker.processed == 3
+    assert worker.errors == 1
+    assert worker.latest == 2
+    assert pool.users == {}
+    assert 'bad buffer' in capsys.readouterr().err
+
+def test_worker_restart_replaces_gap():
+    calls=[]
+    worker=dspWorker(lambda samples: calls.append(('process',int(samples[0]))),
+                     gap=lambda frames: calls.append(('gap',frames)),
+                     restart=lambda: calls.append(('restart',)))
+    worker.start()
+    worker.submit(numpy.zeros(10),block=True,gap=5)
+    worker.submit(numpy.ones(10),block=True,gap=5,restart=True)
+    worker.stop()
+    worker.join(5)
+    assert calls == [('gap',5),('process',0),('restart',),('process',1)]
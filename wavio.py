@@ -0,0 +1,145 @@
+#
+# WAV file loading for reference signals and recordings
+#  Decodes 8/16/24/32-bit integer and 32/64-bit float PCM straight into numpy
+#  arrays, memory-mapping the sample data where the layout allows it
+
+# Copyright (c) 2011, 2022 Michael Robinson
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Version 0.1
+
+import os
+import struct
+import numpy
+
+WAVE_FORMAT_PCM=0x0001
+WAVE_FORMAT_IEEE_FLOAT=0x0003
+WAVE_FORMAT_EXTENSIBLE=0xFFFE
+
+# Walk the RIFF chunks and return (format tag, channels, rate, sample width, data offset, data length)
+def read_header(f):
+    riff,size,wave=struct.unpack('<4sI4s',f.read(12))
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE file')
+
+    fmt=None
+    while True:
+        header=f.read(8)
+        if len(header) < 8:
+            raise ValueError('No data chunk found')
+        chunkId,chunkSize=struct.unpack('<4sI',header)
+        if chunkId == b'fmt ':
+            body=f.read(chunkSize)
+            tag,channels,rate,byteRate,blockAlign,bits=struct.unpack('<HHIIHH',body[:16])
+            if tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                tag=struct.unpack('<H',body[24:26])[0] # First two bytes of the subformat GUID
+            fmt=(tag,channels,rate,blockAlign//channels)
+        elif chunkId == b'data':
+            if fmt is None:
+                raise ValueError('Data chunk precedes fmt chunk')
+            return fmt+(f.tell(),chunkSize)
+        else:
+            f.seek(chunkSize,1)
+        if chunkSize % 2: # Chunks are padded to even length
+            f.seek(1,1)
+
+# Write a PCM header for a data chunk of the given length in bytes
+#  Writes at the current position, which should be the start of the file.
+#  The data chunk starts straight after, at offset HEADER_LENGTH.
+HEADER_LENGTH=44
+def write_header(f,rate,channels=1,width=2,length=0):
+    f.write(struct.pack('<4sI4s4sIHHIIHH4sI',b'RIFF',36+length,b'WAVE',
+                        b'fmt ',16,WAVE_FORMAT_PCM,channels,rate,rate*channels*width,
+                        channels*width,8*width,b'data',length))
+
+# Buffer timestamps stored alongside a raw capture, one record per buffer
+#  frame is the index of the buffer's first frame in the capture and pts its
+#  GStreamer presentation time in nanoseconds (2**64-1 if it had none).
+PTS_DTYPE=numpy.dtype([('frame','<u8'),('pts','<u8')])
+
+# Read a capture written by engine.captureRecorder
+#  Returns the samples and sample rate as read_wav does, and the buffer
+#  timestamp records, all memory-mapped.
+def read_capture(filename):
+    data,rate=read_wav(filename)
+    if os.path.getsize(filename+'.pts') > 0:
+        index=numpy.memmap(filename+'.pts',dtype=PTS_DTYPE,mode='r')
+    else:
+        index=numpy.zeros(0,dtype=PTS_DTYPE)
+    return data,rate,index
+
+# Read a WAV file into an array of shape (frames,channels) or (frames,) if mono
+#  Returns the samples and the sample rate.  8-bit data is recentered about zero,
+#  24-bit data is sign-extended into int32, other widths keep their native dtype.
+def read_wav(filename,mmap=True):
+    with open(filename,'rb') as f:
+        tag,channels,rate,width,offset,length=read_header(f)
+        if not mmap:
+            f.seek(offset)
+            raw=numpy.frombuffer(f.read(length),dtype=numpy.uint8)
+
+    frames=length//(width*channels)
+    nbytes=frames*width*channels
+    if mmap:
+        raw=numpy.memmap(filename,dtype=numpy.uint8,mode='r',offset=offset,shape=(nbytes,))
+    else:
+        raw=raw[:nbytes]
+
+    if tag == WAVE_FORMAT_IEEE_FLOAT and width in (4,8):
+        data=raw.view('<f'+str(width))
+    elif tag != WAVE_FORMAT_PCM:
+        raise ValueError('Unsupported WAV format tag ' + hex(tag))
+    elif width == 1:
+        data=raw.astype(numpy.int16)-128
+    elif width == 2:
+        data=raw.view('<i2')
+    elif width == 3:
+        # Place the three bytes in the top of an int32 and shift back down to sign-extend
+        triples=raw.reshape(-1,3)
+        data=(triples[:,0].astype(numpy.int32) << 8 |
+              triples[:,1].astype(numpy.int32) << 16 |
+              triples[:,2].astype(numpy.int32) << 24) >> 8
+    elif width == 4:
+        data=raw.view('<i4')
+    else:
+        raise ValueError('Unsupported sample width ' + str(width))
+
+    if channels > 1:
+        data=data.reshape(-1,channels)
+    return data,rate
+
+# Scale samples as returned by read_wav to 16-bit full scale
+#  width is the file's sample width in bytes.  Wider integer samples keep
+#  their top 16 bits and float samples, full scale at 1.0, are clipped.
+def to_int16(data,width):
+    if data.dtype.kind == 'f':
+        return numpy.clip(numpy.rint(data*32767.0),-32768,32767).astype(numpy.int16)
+    if width == 1:
+        return data.astype(numpy.int16) << 8
+    if width > 2:
+        return (data >> (8*width-16)).astype(numpy.int16)
+    return numpy.asarray(data,dtype=numpy.int16)
+
+# Load a reference signal as a 1-d float array, taking the requested channel
+def load_reference(filename,channel=0):
+    data,rate=read_wav(filename)
+    if data.ndim > 1:
+        data=data[:,channel]
+    return numpy.asarray(data,dtype=numpy.float64)